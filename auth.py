@@ -1,12 +1,32 @@
+import os
 import json
-import requests
+import time
+import asyncio
+import aiohttp
 
 class Auth():
-    def __init__(self, auth_file):
+    def __init__(self, auth_file, refresh_margin=300.0, validate_ttl=600.0):
         self.__auth_file = auth_file
         self.__auth_json = {}
         self.__load_auth()
         
+        # refresh this many seconds before the access token expires
+        self.__refresh_margin = refresh_margin
+        # how long a validation result is trusted for
+        self.__validate_ttl = validate_ttl
+        
+        self.__expires_at = None
+        self.__validated_token = None
+        self.__validated_at = 0.0
+        self.__is_valid = False
+        # login of the account the access token belongs to, once validated
+        self.__token_user = None
+        
+        self.__session = None
+        self.__refresh_task = None
+        self.__refresher = None
+        self.__expiry_changed = None
+        
     def get_user(self):
         return self.__auth_json['username']
     
@@ -24,32 +44,63 @@ class Auth():
         
     def get_refresh_token(self):
         return self.__auth_json['refresh_token']
+        
+    def get_funtoon_token(self):
+        return self.__auth_json['funtoon_token']
+        
+    def get_token_user(self):
+        return self.__token_user
 
-    def validate_access_token(self):
+    async def start(self):
+        # validate up front so the expiry is known, then keep the token fresh
+        # in the background so nothing has to fail before it gets refreshed
+        await self.get_valid_access_token()
+        if not self.__refresher or self.__refresher.done():
+            self.__expiry_changed = asyncio.Event()
+            self.__refresher = asyncio.get_running_loop().create_task(self.__refresh_ahead())
+            
+    async def close(self):
+        if self.__refresher:
+            self.__refresher.cancel()
+            self.__refresher = None
+        if self.__session:
+            await self.__session.close()
+            self.__session = None
+            
+    async def get_valid_access_token(self):
+        if not await self.validate_access_token():
+            return await self.refresh_access_token()
+        return self.get_access_token()
+        
+    async def validate_access_token(self, force=False):
+        token = self.get_access_token()
+        now = time.monotonic()
+        if self.__expires_at is not None and now >= self.__expires_at:
+            return False
+        if not force and self.__validated_token == token and now - self.__validated_at < self.__validate_ttl:
+            return self.__is_valid
+            
         headers = {
-            'Authorization': f'OAuth {self.__auth.get_access_token()}'
+            'Authorization': f'OAuth {token}'
         }
         
-        r = requests.get('https://id.twitch.tv/oauth2/validate', headers=headers)
-        j = json.loads(r.content)
-        return 'client_id' in j
+        async with self.__get_session().get('https://id.twitch.tv/oauth2/validate', headers=headers) as r:
+            j = await r.json(content_type=None)
+            
+        self.__is_valid = 'client_id' in j
+        self.__validated_token = token
+        self.__validated_at = now
+        if self.__is_valid:
+            self.__token_user = j.get('login', self.__token_user)
+            self.__set_expiry(j.get('expires_in'))
+        return self.__is_valid
         
-    def refresh_access_token(self):
-        params = {
-            'grant_type': 'refresh_token',
-            'refresh_token': self.get_refresh_token(),
-            'client_id': self.get_client_id(),
-            'client_secret': self.get_client_secret()
-        }
-        
-        url = 'https://id.twitch.tv/oauth2/token'
-
-        r = requests.post(url, params=params)
-        j = json.loads(r.content)
-        new_access_token = j['access_token']
-        new_refresh_token = j['refresh_token']
-        self.__assign_new_access_token(new_access_token, new_refresh_token)
-        return new_access_token
+    async def refresh_access_token(self):
+        # everyone asking at once shares a single refresh, a refresh token
+        # can only be used once
+        if not self.__refresh_task or self.__refresh_task.done():
+            self.__refresh_task = asyncio.get_running_loop().create_task(self.__refresh())
+        return await asyncio.shield(self.__refresh_task)
         
     ###########################################################################
     # Private helper methods
@@ -59,14 +110,75 @@ class Auth():
             with open(self.__auth_file, 'r') as f:
                 self.__auth_json = json.load(f)
         except IOError:
-            print(f"Unable to open auth file '{__auth_file}'")
-            
-    def __save_auth(self):
-        with open(self.__auth_file, 'w') as f:
-            json.dump(self.__auth_json, f, indent=4)
+            print(f"Unable to open auth file '{self.__auth_file}'")
             
-    def __assign_new_access_token(self, new_access_token, new_refresh_token):
+    def __save_auth(self, auth_json):
+        # write next to it and rename over, a crash mid write can't lose the tokens
+        temp_file = f'{self.__auth_file}.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(auth_json, f, indent=4)
+        os.replace(temp_file, self.__auth_file)
+        
+    async def __assign_new_access_token(self, new_access_token, new_refresh_token):
         self.__auth_json['access_token'] = new_access_token
         self.__auth_json['refresh_token'] = new_refresh_token
-        self.__save_auth()
+        await asyncio.get_running_loop().run_in_executor(None, self.__save_auth, dict(self.__auth_json))
+        
+    def __get_session(self):
+        if not self.__session or self.__session.closed:
+            self.__session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        return self.__session
+        
+    def __set_expiry(self, expires_in):
+        # app tokens that never expire report 0
+        self.__expires_at = time.monotonic() + expires_in if expires_in else None
+        if self.__expiry_changed:
+            self.__expiry_changed.set()
+            
+    async def __refresh(self):
+        params = {
+            'grant_type': 'refresh_token',
+            'refresh_token': self.get_refresh_token(),
+            'client_id': self.get_client_id(),
+            'client_secret': self.get_client_secret()
+        }
+        
+        url = 'https://id.twitch.tv/oauth2/token'
+        
+        async with self.__get_session().post(url, params=params) as r:
+            j = await r.json(content_type=None)
+        new_access_token = j['access_token']
+        new_refresh_token = j['refresh_token']
+        await self.__assign_new_access_token(new_access_token, new_refresh_token)
+        
+        # a fresh token is known good, no need to validate it again right away
+        self.__validated_token = new_access_token
+        self.__validated_at = time.monotonic()
+        self.__is_valid = True
+        self.__set_expiry(j.get('expires_in'))
+        print('Access token refreshed.')
+        return new_access_token
+        
+    async def __refresh_ahead(self):
+        while True:
+            self.__expiry_changed.clear()
+            if self.__expires_at is None:
+                delay = self.__validate_ttl
+            else:
+                delay = max(0.0, self.__expires_at - self.__refresh_margin - time.monotonic())
+                
+            try:
+                await asyncio.wait_for(self.__expiry_changed.wait(), delay)
+                continue
+            except asyncio.TimeoutError:
+                pass
+                
+            try:
+                if self.__expires_at is None:
+                    await self.get_valid_access_token()
+                else:
+                    await self.refresh_access_token()
+            except (aiohttp.ClientError, asyncio.TimeoutError, KeyError) as e:
+                print(f'Unable to refresh the access token: {e}')
+                await asyncio.sleep(30)
         
\ No newline at end of file
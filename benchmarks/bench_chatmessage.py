@@ -0,0 +1,141 @@
+import sys
+import os
+import time
+import asyncio
+import inspect
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.chatmessage import tokenize_message
+
+# Strip-and-restore cost on emote-heavy chat messages: the old per-emote
+# slicing/str.replace approach against the single-pass tokenizer.
+
+class FakeMessage():
+    def __init__(self, content, emotes):
+        self.content = content
+        self.tags = { 'emotes': emotes }
+
+def make_message(num_emotes, words_between=1, num_distinct=5):
+    names = ['Kappa', 'PogChamp', 'LUL', 'Kreygasm', 'BibleThump']
+    parts = []
+    ranges = dict()
+    pos = 0
+    for i in range(num_emotes):
+        name = names[i % len(names)]
+        ranges.setdefault(str(25 + i % num_distinct), []).append(f'{pos}-{pos + len(name) - 1}')
+        parts.append(name)
+        pos += len(name) + 1
+        for _ in range(words_between):
+            parts.append('wow')
+            pos += 4
+    emotes = '/'.join(f'{emote_id}:{",".join(r)}' for emote_id, r in ranges.items())
+    return FakeMessage(' '.join(parts), emotes)
+
+def legacy_strip(message):
+    if not 'emotes' in message.tags or message.tags['emotes'] == '':
+        return message.content, []
+    to_replace = []
+    for emote in message.tags['emotes'].split('/'):
+        id, replacement = emote.split(':')
+        for splice in replacement.split(','):
+            start, end = splice.split('-')
+            to_replace.append((int(start), int(end)+1, id))
+    to_replace = sorted(to_replace, key=lambda x: x[0], reverse=True)
+    emote_text = {}
+    new_message = message.content
+    for start, end, id in to_replace:
+        if not id in emote_text:
+            emote_text[id] = new_message[start:end]
+        new_message = f'{new_message[:start]}__{id}__{new_message[end:]}'
+    return new_message, emote_text
+
+def legacy_fix(message, emotes):
+    for emote_id in emotes:
+        message = message.replace(f'__{emote_id}__', emotes[emote_id])
+    return message
+
+# twitchio's Bot.__get_prefixes__ and Bot.get_prefix with prefix='!'
+PREFIX = '!'
+
+async def legacy_get_prefixes(message):
+    ret = PREFIX
+    if callable(PREFIX):
+        ret = PREFIX(None, message)
+    if not isinstance(ret, (list, tuple, set, str)):
+        raise TypeError(f'Prefix must be of either class <list, tuple, set, str> not <{type(ret)}>')
+    return ret
+
+async def legacy_get_prefix(message):
+    prefixes = await legacy_get_prefixes(message)
+    if 'reply-parent-msg-id' in message.tags:
+        content = ' '.join(message.content.split(' ')[1:])
+    else:
+        content = message.content
+    if not isinstance(prefixes, str):
+        for prefix in prefixes:
+            if content.startswith(prefix):
+                return prefix
+    elif content.startswith(prefixes):
+        return prefixes
+    return None
+
+async def legacy_strip_path(message):
+    # what every chat message paid before reaching the translator, the
+    # prefix was awaited before anything else
+    if await legacy_get_prefix(message):
+        return None
+    return legacy_strip(message)
+
+def tokenized_strip_path(message):
+    tokens = tokenize_message(message, '!')
+    if tokens.is_emote_only or tokens.is_command:
+        return None
+    return tokens.stripped_text()
+
+def legacy_round_trip(message):
+    stripped, emotes = legacy_strip(message)
+    return legacy_fix(stripped, emotes)
+
+def tokenized_round_trip(message):
+    tokens = tokenize_message(message, '!')
+    return tokens.restore_emotes(tokens.stripped_text())
+
+async def legacy_translate_path(message):
+    # a translated message, the prefix lookup and stripping happen once
+    if await legacy_get_prefix(message):
+        return None
+    stripped, emotes = legacy_strip(message)
+    return legacy_fix(stripped, emotes)
+
+def tokenized_translate_path(message):
+    tokens = tokenize_message(message, '!')
+    if tokens.is_emote_only or tokens.is_command:
+        return None
+    return tokens.restore_emotes(tokens.stripped_text())
+
+async def bench(fn, message, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = fn(message)
+        if inspect.isawaitable(result):
+            await result
+    return (time.perf_counter() - start) / iterations
+
+async def main():
+    # (emotes, words between them, distinct emotes)
+    cases = [(0, 3, 1), (1, 3, 1), (10, 1, 5), (50, 1, 5), (200, 1, 5), (50, 0, 5), (200, 0, 5), (50, 1, 50), (200, 1, 200)]
+    for title, before_fn, after_fn in [('strip (every message)', legacy_strip_path, tokenized_strip_path), ('strip + restore (translated messages)', legacy_translate_path, tokenized_translate_path)]:
+        print(title)
+        print(f'{"emotes":>10} {"legacy":>12} {"tokenized":>12} {"speedup":>8}')
+        for num_emotes, words_between, num_distinct in cases:
+            message = make_message(num_emotes, words_between, num_distinct)
+            assert legacy_round_trip(message) == tokenized_round_trip(message) == message.content
+            iterations = max(200, 20000 // max(1, num_emotes))
+            before = await bench(before_fn, message, iterations)
+            after = await bench(after_fn, message, iterations)
+            label = f'{num_emotes}{" only" if not words_between else ""}{" distinct" if num_distinct == num_emotes > 1 else ""}'
+            print(f'{label:>10} {before * 1e6:10.2f}us {after * 1e6:10.2f}us {before / after:7.2f}x')
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,198 @@
+import sys
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from stashiobot import Bot
+from channel_context import ChannelContext
+from supermetroidmanager import SuperMetroidRunManager, SuperMetroidCallbacks
+from utils.fake_qusb2snes import FakeQUsb2Snes
+from utils.funtoon import FuntoonDispatcher
+from utils.supermetroid import Rooms, GameStates
+
+# End-to-end latency from Samus entering the Moat in WRAM until 'phanopen'
+# reaches Funtoon, driven through SuperMetroid, SuperMetroidRunManager and
+# Bot.funtoon_custom_event against a fake QUsb2Snes and a fake Funtoon.
+#
+# Stages:
+#   device read      - WRAM changed -> the poll that sees it has returned
+#   change detection - poll returned -> the run manager's callback fired
+#   callback         - run manager callback -> Bot.funtoon_custom_event
+#   http dispatch    - Bot.funtoon_custom_event -> request received by Funtoon,
+#                      through the FuntoonDispatcher queue
+#
+# Exits with 1 when a stage's p95 goes over its threshold.
+
+STAGES = ['device read', 'change detection', 'callback', 'http dispatch', 'total']
+
+# p95 thresholds in ms, the device read is dominated by the poll interval
+THRESHOLDS = {
+    'device read'     : 250.0,
+    'change detection': 5.0,
+    'callback'        : 5.0,
+    'http dispatch'   : 50.0,
+    'total'           : 300.0,
+}
+
+ADDR_ROOM_ID    = 0x079B
+ADDR_GAME_STATE = 0x0998
+
+class FakeFuntoon():
+    def __init__(self, loop):
+        self.loop = loop
+        self.received = asyncio.Queue()
+        
+        funtoon = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                received_at = time.perf_counter()
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                self.send_response(200)
+                self.end_headers()
+                funtoon.loop.call_soon_threadsafe(funtoon.received.put_nowait, (body['event'], received_at))
+                
+            def log_message(self, *args):
+                pass
+                
+        self.__server = ThreadingHTTPServer(('localhost', 0), Handler)
+        self.url = f'http://localhost:{self.__server.server_address[1]}/api/events/custom'
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        
+    def stop(self):
+        self.__server.shutdown()
+
+class FakeAuth():
+    def get_funtoon_token(self):
+        return 'benchmark'
+        
+    def get_user(self):
+        return 'benchmark'
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))]
+
+def make_bot(funtoon_url, marks):
+    # a Bot that never talks to Twitch, only the parts the game callbacks touch
+    bot = Bot.__new__(Bot)
+    bot.auth = FakeAuth()
+    bot.sm_channel = 'benchmark'
+    bot.channels = { bot.sm_channel: ChannelContext(bot.sm_channel) }
+    bot.funtoon = FuntoonDispatcher(funtoon_url, bot.auth)
+    
+    funtoon_custom_event = bot.funtoon_custom_event
+    def timed_funtoon_custom_event(*args, **kwargs):
+        marks['event'] = time.perf_counter()
+        return funtoon_custom_event(*args, **kwargs)
+    bot.funtoon_custom_event = timed_funtoon_custom_event
+    return bot
+
+def make_callbacks(bot, marks):
+    def enter_moat():
+        marks['callback'] = time.perf_counter()
+        bot.enter_moat()
+        
+    return SuperMetroidCallbacks(
+        run_started        = bot.run_started,
+        run_reset          = bot.run_reset,
+        enter_phantoon     = bot.enter_phantoon,
+        enter_moat         = enter_moat,
+        phantoon_fight_end = bot.phantoon_fight_end,
+        samus_dead         = None,
+        ceres_start        = None,
+        ceres_end          = None,
+        ceres_timer        = None,
+    )
+
+def instrument_device(manager, target_room, marks):
+    # note when the first poll that can see the Moat comes back
+    sm = manager._SuperMetroidRunManager__sm
+    device = sm._SuperMetroid__qusb2snes_device
+    read_wram_plan = device.read_wram_plan
+    room_addr = FakeQUsb2Snes.WramBase + ADDR_ROOM_ID
+    async def timed_read_wram_plan(plan):
+        results = await read_wram_plan(plan)
+        if 'read' not in marks and marks.get('changed') and results:
+            for (addr, _), value in zip(plan.addr_and_sizes, results):
+                if addr == room_addr and value == target_room:
+                    marks['read'] = time.perf_counter()
+        return results
+    device.read_wram_plan = timed_read_wram_plan
+
+async def wait_for_device(manager):
+    sm = manager._SuperMetroidRunManager__sm
+    while not sm._SuperMetroid__qusb2snes_device:
+        await asyncio.sleep(0.01)
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds the fake device adds to each reply')
+    parser.add_argument('--threshold', action='append', default=[], metavar='STAGE=MS', help="override a p95 threshold, e.g. 'http dispatch=20'")
+    args = parser.parse_args()
+    
+    thresholds = dict(THRESHOLDS)
+    for override in args.threshold:
+        stage, ms = override.rsplit('=', 1)
+        thresholds[stage] = float(ms)
+    
+    loop = asyncio.get_running_loop()
+    funtoon = FakeFuntoon(loop)
+    marks = dict()
+    samples = { stage: [] for stage in STAGES }
+    
+    async with FakeQUsb2Snes(port=0, latency=args.latency) as device:
+        bot = make_bot(funtoon.url, marks)
+        manager = SuperMetroidRunManager(make_callbacks(bot, marks), 'localhost', device.port)
+        manager.enable_threads(loop)
+        await wait_for_device(manager)
+        instrument_device(manager, Rooms.Crateria.Moat, marks)
+        
+        # start a run so the manager reacts to room transitions
+        device.poke(ADDR_GAME_STATE, GameStates.GameOptionsMenu)
+        await asyncio.sleep(0.5)
+        device.poke(ADDR_GAME_STATE, GameStates.NewGamePostIntro)
+        await asyncio.sleep(0.5)
+        device.poke(ADDR_GAME_STATE, GameStates.Gameplay)
+        
+        for _ in range(args.iterations):
+            device.poke(ADDR_ROOM_ID, Rooms.Crateria.Kihunter)
+            bot.channels[bot.sm_channel].is_phan_open = False
+            # don't let the change line up with the same point of the poll interval every time
+            await asyncio.sleep(0.3 + random.random() * 0.2)
+            
+            marks.clear()
+            marks['changed'] = time.perf_counter()
+            device.poke(ADDR_ROOM_ID, Rooms.Crateria.Moat)
+            
+            event, received_at = await asyncio.wait_for(funtoon.received.get(), 5.0)
+            assert event == 'phanopen', event
+            
+            samples['device read'].append(marks['read'] - marks['changed'])
+            samples['change detection'].append(marks['callback'] - marks['read'])
+            samples['callback'].append(marks['event'] - marks['callback'])
+            samples['http dispatch'].append(received_at - marks['event'])
+            samples['total'].append(received_at - marks['changed'])
+            
+        await bot.funtoon.close()
+    funtoon.stop()
+    
+    failed = False
+    print(f'{"stage":<18} {"p50":>9} {"p95":>9} {"p99":>9} {"limit":>9}')
+    for stage in STAGES:
+        p50, p95, p99 = [percentile(samples[stage], p) * 1000.0 for p in (50, 95, 99)]
+        over = p95 > thresholds[stage]
+        failed = failed or over
+        print(f'{stage:<18} {p50:8.3f}ms {p95:8.3f}ms {p99:8.3f}ms {thresholds[stage]:8.1f}ms{"  REGRESSED" if over else ""}')
+        
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
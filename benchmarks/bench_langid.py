@@ -0,0 +1,61 @@
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.langid import LanguageIdentifier
+
+# How many remote detection calls the local language prefilter avoids on a
+# chat corpus, how many non-English messages it wrongly lets through as
+# English, and what it costs per message. Emotes are already replaced with
+# __id__ placeholders, like MessageTranslator does before translating.
+
+CORPUS = [
+    ('en', 'that phantoon was so fast lol'), ('en', 'gg'), ('en', 'what a great run'), ('en', 'nice split'),
+    ('en', 'this is the best stream ever'), ('en', 'how long have you been running this game'),
+    ('en', 'is that a pb pace'), ('en', 'lets go'), ('en', 'that was clean'), ('en', 'rip the run'),
+    ('en', 'wait what happened'), ('en', 'i think you can make it'), ('en', 'good luck on the reset'),
+    ('en', 'lol __25__'), ('en', '__425618__ gg wp'), ('en', 'you got this'), ('en', 'that ceres time though'),
+    ('en', 'how do you do the moat so fast'), ('en', 'love the stream'), ('en', 'omg that was so close'),
+    ('en', 'first time watching, this is cool'), ('en', 'what route is this'), ('en', 'hi chat'),
+    ('en', 'thanks for the raid'), ('en', 'is this any percent'), ('en', 'do you stream every day'),
+    ('en', 'seriously insane movement'), ('en', 'speedrunning looks exhausting honestly'),
+    ('en', 'incredible'), ('en', 'the boss fight was brutal'), ('en', 'im back'), ('en', 'brb'),
+    ('en', 'what is the world record'), ('en', 'i need to sleep but this run'), ('en', 'so good'),
+    ('en', 'that eye timer was fast'), ('en', 'nice phantoon'), ('en', 'yeah that happens'),
+    ('other', 'bonjour tout le monde'), ('other', 'hola como estas'), ('other', 'ich bin müde heute'),
+    ('other', 'questo è molto bello'), ('other', 'wie geht es dir'), ('other', 'que pasa amigos'),
+    ('other', "mais oui c'est incroyable"), ('other', 'das war richtig gut'), ('other', 'buenas noches'),
+    ('other', 'obrigado pela live'), ('other', 'привет всем'), ('other', 'こんにちは'), ('other', '안녕하세요'),
+    ('other', 'la vida es bella'), ('other', 'muito bom mano'), ('other', 'je suis content'),
+    ('other', 'goede run'), ('other', 'dziękuję bardzo'), ('other', 'merci beaucoup'),
+    ('trivial', '__25__'), ('trivial', '__25__ __25__ __25__'), ('trivial', '!uptime'), ('trivial', '!pb'),
+    ('trivial', '123'), ('trivial', '???'), ('trivial', 'https://clips.twitch.tv/SomeClip'), ('trivial', ':)'),
+]
+
+def main(repeats=2000):
+    language_id = LanguageIdentifier()
+    
+    remote = 0
+    wrongly_skipped = []
+    for label, text in CORPUS:
+        if language_id.is_untranslatable(text) or language_id.is_confidently_english(text):
+            if label == 'other':
+                wrongly_skipped.append(text)
+        else:
+            remote += 1
+            
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for _, text in CORPUS:
+            language_id.is_untranslatable(text) or language_id.is_confidently_english(text)
+    per_message = (time.perf_counter() - start) / (repeats * len(CORPUS))
+    
+    print(f'messages            : {len(CORPUS)}')
+    print(f'remote calls avoided: {1 - remote / len(CORPUS):.1%} ({len(CORPUS) - remote} of {len(CORPUS)})')
+    print(f'non-English skipped : {len(wrongly_skipped)} {wrongly_skipped if wrongly_skipped else ""}')
+    print(f'cpu per message     : {per_message * 1e6:.2f} us')
+
+if __name__ == '__main__':
+    main()
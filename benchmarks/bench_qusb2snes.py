@@ -0,0 +1,75 @@
+import sys
+import os
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.qusb2snes import QUsb2Snes
+from utils.fake_qusb2snes import FakeQUsb2Snes
+
+# Transport benchmark against the bundled fake QUsb2Snes server: round trip
+# latency and reads per second for read_wram and read_wram_batch, pipelined
+# reads, and how long a reconnection takes.
+
+# the fields SuperMetroid reads in Phantoon's room with Ceres subscribed
+SM_READS = [(0x079B, 2), (0x0998, 2), (0x09C2, 2), (0x05B6, 2), (0x0F8C, 2), (0x0FE8, 2), (0x0945, 2), (0x093F, 2)]
+
+def report(name, samples):
+    samples = sorted(samples)
+    p = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000.0
+    print(f'{name:<24} {len(samples) / sum(samples):>10,.0f} reads/s   p50 {p(0.50):6.3f} ms   p95 {p(0.95):6.3f} ms   p99 {p(0.99):6.3f} ms')
+
+async def timed(coro_factory, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = await coro_factory()
+        samples.append(time.perf_counter() - start)
+        assert result is not None
+    return samples
+
+async def connect(server):
+    qusb2snes = QUsb2Snes(server.hostname, server.port)
+    await qusb2snes.connect()
+    devices = await qusb2snes.get_devices()
+    return qusb2snes, await qusb2snes.attach_to_device(devices['Results'][0])
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the fake server adds to each reply')
+    parser.add_argument('--fragment-size', type=int, default=None)
+    args = parser.parse_args()
+    
+    async with FakeQUsb2Snes(port=0, latency=args.latency, fragment_size=args.fragment_size) as server:
+        qusb2snes, device = await connect(server)
+        
+        report('read_wram', await timed(lambda: device.read_wram(0x09C2, 2), args.iterations))
+        report('read_wram_batch', await timed(lambda: device.read_wram_batch(SM_READS), args.iterations))
+        
+        plan = device.compile_wram_plan(SM_READS)
+        report('read_wram_plan', await timed(lambda: device.read_wram_plan(plan), args.iterations))
+        
+        # 8 independent readers sharing the connection
+        start = time.perf_counter()
+        await asyncio.gather(*[timed(lambda: device.read_wram(0x09C2, 2), args.iterations // 8) for _ in range(8)])
+        elapsed = time.perf_counter() - start
+        print(f'{"8 concurrent read_wram":<24} {(args.iterations // 8) * 8 / elapsed:>10,.0f} reads/s')
+        
+        reconnects = []
+        for _ in range(10):
+            await server.disconnect_clients()
+            start = time.perf_counter()
+            while not qusb2snes.is_disconnected():
+                await asyncio.sleep(0)
+            while qusb2snes.is_disconnected():
+                await qusb2snes.reconnect_to_device()
+            assert await device.read_wram(0x09C2, 2) is not None
+            reconnects.append(time.perf_counter() - start)
+        print(f'{"reconnect":<24} mean {statistics.mean(reconnects) * 1000.0:6.3f} ms   max {max(reconnects) * 1000.0:6.3f} ms')
+
+if __name__ == '__main__':
+    asyncio.run(main())
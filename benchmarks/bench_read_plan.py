@@ -0,0 +1,106 @@
+import sys
+import os
+import time
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.qusb2snes import WramReadPlanner
+from utils.supermetroid import SuperMetroid, Rooms, PollScheduler
+
+# Measures the Python-side cost of one SuperMetroid.__read_updated_memory call
+# with the device read taken out, before (rebuilding the read lists every tick)
+# and after (cached, precompiled read plan). Every field is read on every
+# tick in both, the per-field poll rates would otherwise leave most ticks empty.
+
+class EveryTickScheduler(PollScheduler):
+    # never pushes a field's next poll out, so all of them are always due
+    def polled(self, fields, now, get_rate):
+        pass
+
+class InstantDevice():
+    def __init__(self):
+        self.__planner = WramReadPlanner()
+        self.last_num_fields = 0
+        
+    def compile_wram_plan(self, addr_and_sizes):
+        return self.__planner.plan(addr_and_sizes, 64, 8)
+        
+    async def read_wram_plan(self, plan):
+        results = plan.decode(bytes(plan.num_bytes))
+        self.last_num_fields = len(results)
+        return results
+        
+    async def read_wram_batch(self, addr_and_sizes):
+        # what QUsb2Snes.read_wram_batch has to do for an uncompiled batch
+        return await self.read_wram_plan(self.compile_wram_plan(addr_and_sizes))
+
+async def ceres_update(mem):
+    pass
+
+async def legacy_read_updated_memory(device, wram_offsets, prev_game_info, current_subscriptions):
+    # the per-tick list building that __read_updated_memory used to do
+    mem = dict()
+    all_reads = []
+    names = []
+    
+    for field in wram_offsets['always_update']:
+        info = wram_offsets['always_update'][field]
+        names.append(field)
+        all_reads.append((info['offset'], info['size']))
+    
+    if prev_game_info and prev_game_info['room_id'] in wram_offsets['room_update']:
+        room_info = wram_offsets['room_update'][prev_game_info['room_id']]
+        for field in room_info:
+            info = room_info[field]
+            names.append(field)
+            all_reads.append((info['offset'], info['size']))
+            
+    for sub, sub_callback in current_subscriptions:
+        if sub in wram_offsets['subscriptions']:
+            sub_info = wram_offsets['subscriptions'][sub]
+            for mem_name in sub_info:
+                names.append(mem_name)
+                all_reads.append((sub_info[mem_name]['offset'], sub_info[mem_name]['size']))
+            
+    results = await device.read_wram_batch(all_reads)
+    if len(results) == len(names):
+        for i in range(len(names)):
+            mem[names[i]] = results[i]
+        for sub, sub_callback in current_subscriptions:
+            if sub in wram_offsets['subscriptions']:
+                await sub_callback(mem)
+    return mem
+
+async def time_ticks(tick, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await tick()
+    return (time.perf_counter() - start) / iterations
+
+async def main(iterations=100000):
+    device = InstantDevice()
+    sm = SuperMetroid()
+    sm._SuperMetroid__qusb2snes_device = device
+    sm._SuperMetroid__prev_game_info = {'room_id': Rooms.WreckedShip.Phantoon}
+    sm.subscribe_to_memory_update(SuperMetroid.MemoryUpdates.Ceres, ceres_update)
+    sm._SuperMetroid__poll_scheduler = EveryTickScheduler()
+    
+    wram_offsets = sm._SuperMetroid__wram_offsets
+    prev_game_info = sm._SuperMetroid__prev_game_info
+    subscriptions = [(SuperMetroid.MemoryUpdates.Ceres, ceres_update)]
+    
+    before = await time_ticks(lambda: legacy_read_updated_memory(device, wram_offsets, prev_game_info, subscriptions), iterations)
+    after = await time_ticks(sm._SuperMetroid__read_updated_memory, iterations)
+    
+    await legacy_read_updated_memory(device, wram_offsets, prev_game_info, subscriptions)
+    num_before = device.last_num_fields
+    await sm._SuperMetroid__read_updated_memory()
+    print(f'fields read a tick : {num_before:8d} before, {device.last_num_fields} after')
+    
+    print(f'rebuild every tick : {before * 1e6:8.2f} us/tick')
+    print(f'cached read plan   : {after * 1e6:8.2f} us/tick')
+    print(f'speedup            : {before / after:8.2f}x')
+
+if __name__ == '__main__':
+    asyncio.run(main())
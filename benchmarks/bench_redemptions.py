@@ -0,0 +1,127 @@
+import sys
+import os
+import json
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pubsub
+from pubsub import decode_reward_redemption
+from utils import jsonparse
+
+# Decode cost of a hype-train sized burst of channel points redemptions: the
+# old json.loads + four JsonParse.get walks against the single pass decoder.
+# The burst is generated from the reward-redeemed message layout Twitch
+# sends, with the field sizes and user inputs varied like real traffic.
+
+REWARDS = [
+    ('79d9ed5c-6f65-4b81-8c27-71a9f3d7b181', 'TTS', True),
+    ('e86c82b1-0d47-4f18-aa00-d6f9c764e4d4', 'Change Stashio pic', False),
+]
+
+def make_redemption(rng, i):
+    reward_id, title, is_user_input_required = REWARDS[i % len(REWARDS)]
+    login = f'viewer{rng.randrange(100000)}'
+    return json.dumps({
+        'type': 'reward-redeemed',
+        'data': {
+            'timestamp': '2026-10-18T20:00:00.000000000Z',
+            'redemption': {
+                'id': f'{rng.getrandbits(128):032x}',
+                'user': { 'id': str(rng.randrange(10**8)), 'login': login, 'display_name': login.capitalize() },
+                'channel_id': '12345678',
+                'redeemed_at': '2026-10-18T20:00:00.000000000Z',
+                'reward': {
+                    'id': reward_id,
+                    'channel_id': '12345678',
+                    'title': title,
+                    'prompt': 'Say something, <0>-<9> picks a voice' if is_user_input_required else '',
+                    'cost': 500,
+                    'is_user_input_required': is_user_input_required,
+                    'is_sub_only': False,
+                    'image': None,
+                    'default_image': {
+                        'url_1x': 'https://static-cdn.jtvnw.net/custom-reward-images/default-1.png',
+                        'url_2x': 'https://static-cdn.jtvnw.net/custom-reward-images/default-2.png',
+                        'url_4x': 'https://static-cdn.jtvnw.net/custom-reward-images/default-4.png',
+                    },
+                    'background_color': '#00C7AC',
+                    'is_enabled': True,
+                    'is_paused': False,
+                    'is_in_stock': True,
+                    'max_per_stream': { 'is_enabled': False, 'max_per_stream': 0 },
+                    'should_redemptions_skip_request_queue': False,
+                },
+                'user_input': ' '.join(rng.choice(['pog', 'hello', 'phantoon', 'is', 'RNG', 'again', '<3>']) for _ in range(rng.randrange(1, 30))) if is_user_input_required else '',
+                'status': 'UNFULFILLED',
+            },
+        },
+    })
+
+class LegacyJsonParse():
+    # JsonParse as it was, re-splitting the path and walking from the root
+    def __init__(self, json_data):
+        self.__data = json_data
+    
+    def get(self, path, default = None):
+        keys = path.split("/")
+        val = None
+        
+        for key in keys:
+            if val:
+                if isinstance(val, list):
+                    val = [ v.get(key, default) if v else None for v in val]
+                else:
+                    val = val.get(key, default)
+            else:
+                val = self.__data.get(key, default)
+            
+            if not val:
+                break;
+        
+        return val
+
+def legacy_decode(message):
+    parse = LegacyJsonParse(json.loads(message))
+    if parse.get('type') == "reward-redeemed":
+        return parse.get('data/redemption/user/login'), parse.get('data/redemption/user_input'), parse.get('data/redemption/reward/id'), parse.get('data/redemption/channel_id')
+    return None
+
+def decoder_decode(message):
+    redemption = decode_reward_redemption(message)
+    return redemption.user, redemption.message, redemption.reward_id, redemption.channel_id
+
+def bench(fn, burst, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for message in burst:
+            fn(message)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    rng = random.Random(21)
+    burst = [make_redemption(rng, i) for i in range(2000)]
+    assert [legacy_decode(m) for m in burst] == [decoder_decode(m) for m in burst]
+    
+    results = [('legacy', bench(legacy_decode, burst, 10))]
+    if jsonparse.loads is not json.loads:
+        results.append(('decoder (orjson)', bench(decoder_decode, burst, 10)))
+        # what it costs without orjson installed
+        loads = jsonparse.loads
+        pubsub.loads = json.loads
+        results.append(('decoder (json)', bench(decoder_decode, burst, 10)))
+        pubsub.loads = loads
+    else:
+        results.append(('decoder (json)', bench(decoder_decode, burst, 10)))
+    
+    print(f'{len(burst)} redemptions')
+    print(f'{"":>18} {"total":>10} {"per msg":>10} {"speedup":>8}')
+    for name, elapsed in results:
+        print(f'{name:>18} {elapsed * 1e3:8.2f}ms {elapsed / len(burst) * 1e6:8.2f}us {results[0][1] / elapsed:7.2f}x')
+
+if __name__ == '__main__':
+    main()
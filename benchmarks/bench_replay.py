@@ -0,0 +1,94 @@
+import sys
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.snapshotlog import SnapshotRecorder
+from utils.supermetroid import SuperMetroid, Rooms, GameStates, CeresEscapeState
+from supermetroidmanager import SuperMetroidRunManager, SuperMetroidCallbacks
+
+# Replays a synthetic run (title -> Ceres -> Moat -> Phantoon) through
+# SuperMetroid and SuperMetroidRunManager with no device attached and reports
+# how many snapshots per second the full callback chain gets through.
+# --room-watches adds that many extra room transition subscriptions (plus an
+# any -> any one) like a full split/room timing setup would, the per-snapshot
+# cost shouldn't move with it.
+
+FIELDS = ['room_id', 'game_state', 'samus_hp', 'frame_counter', 'enemy_hp', 'phantoon_eye_timer', 'ceres_timer', 'ceres_state']
+
+def scripted_run():
+    frame = 0
+    state = { 'room_id': Rooms.Empty, 'game_state': GameStates.GameOptionsMenu, 'samus_hp': 99, 'ceres_timer': 0x100, 'ceres_state': CeresEscapeState.NotInEscape }
+    
+    def hold(frames, **changes):
+        nonlocal frame
+        state.update(changes)
+        for _ in range(frames):
+            frame += 1
+            yield dict(state, frame_counter=frame & 0xFFFF)
+            
+    yield from hold(30)
+    yield from hold(10, game_state=GameStates.NewGamePostIntro)
+    yield from hold(300, game_state=GameStates.Gameplay, room_id=Rooms.Ceres.Elevator)
+    yield from hold(300, ceres_state=CeresEscapeState.EscapeTimerInitiated)
+    yield from hold(10, game_state=GameStates.BlackoutFromCeres)
+    yield from hold(10, game_state=GameStates.CeresDestroyedCinematic, ceres_timer=0x59)
+    yield from hold(300, game_state=GameStates.Gameplay, room_id=Rooms.Crateria.Kihunter)
+    yield from hold(300, room_id=Rooms.Crateria.Moat)
+    yield from hold(300, room_id=Rooms.WreckedShip.Basement)
+    yield from hold(60, room_id=Rooms.WreckedShip.Phantoon, enemy_hp=0)
+    yield from hold(30, enemy_hp=2500, phantoon_eye_timer=0x30)
+    for hp in range(2500, 0, -100):
+        yield from hold(20, enemy_hp=hp, phantoon_eye_timer=(hp * 7) & 0x2FF)
+    yield from hold(60, enemy_hp=0)
+    yield from hold(60, room_id=Rooms.Empty, game_state=GameStates.GameOptionsMenu)
+
+def write_log(path, repeats):
+    recorder = SnapshotRecorder(path, FIELDS)
+    for _ in range(repeats):
+        for snapshot in scripted_run():
+            recorder.write(snapshot)
+    recorder.close()
+    return recorder.num_records
+
+def add_room_watches(manager, num_watches, transitions):
+    sm = manager._SuperMetroidRunManager__sm
+    for i in range(num_watches):
+        # rooms that never show up in the run, only the lookup cost matters
+        sm.subscribe_to_room_transition(0x10000 + i, 0x20000 + i, lambda: None)
+    sm.subscribe_to_room_transition(SuperMetroid.AnyRoom, SuperMetroid.AnyRoom, lambda before, after: transitions.append((before, after)))
+
+async def main(repeats=50, room_watches=0):
+    events = []
+    transitions = []
+    names = ['run_started', 'run_reset', 'enter_phantoon', 'enter_moat', 'phantoon_fight_end', 'samus_dead', 'ceres_start', 'ceres_end', 'ceres_timer']
+    callbacks = SuperMetroidCallbacks(*[(lambda name: lambda *args: events.append(name))(name) for name in names])
+    manager = SuperMetroidRunManager(callbacks)
+    if room_watches:
+        add_room_watches(manager, room_watches, transitions)
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'run.smsnap')
+        num_records = write_log(path, repeats)
+        
+        start = time.perf_counter()
+        num_snapshots = await manager.replay(path)
+        elapsed = time.perf_counter() - start
+        
+    assert num_snapshots == num_records
+    print(f'snapshots : {num_snapshots}')
+    print(f'events    : {len(events)} ({", ".join(sorted(set(events)))})')
+    if room_watches:
+        print(f'room watches: {room_watches}, room changes seen: {len(transitions)}')
+    print(f'throughput: {num_snapshots / elapsed:,.0f} snapshots/s ({elapsed * 1e6 / num_snapshots:.2f} us each)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--room-watches', type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(main(args.repeats, args.room_watches))
@@ -0,0 +1,17 @@
+class ChannelContext():
+    # Everything the bot keeps per joined channel. Slotted, and the channel
+    # rewards are only created on the first redemption, so a channel that
+    # never redeems anything costs next to nothing.
+    __slots__ = ('name', 'channel_id', 'rewards', 'sm_games', 'funtoon_channel', 'is_phan_open', 'is_ceres_open', 'is_ceres_timer_ready')
+    
+    def __init__(self, name):
+        self.name = name
+        self.channel_id = None
+        self.rewards = None
+        
+        # Super Metroid run state, sent to Funtoon for this channel
+        self.sm_games = True
+        self.funtoon_channel = name
+        self.is_phan_open = False
+        self.is_ceres_open = False
+        self.is_ceres_timer_ready = False
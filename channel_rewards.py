@@ -1,55 +1,103 @@
 import utils.tts as tts
 from utils.images import ImageHandler
+from utils.picserver import PictureServer
+from utils.rewardexecutor import RecentIds, RewardExecutor
 import re
 import json
+import asyncio
 
 class ChannelRewards():
-    def __init__(self):
-        self.__obs_pic_location = 'stashiobot_pic'
+    def __init__(self, tts_backend='pyttsx3', picture_server_port=None, channel=None, voice=None, helix=None):
+        # other channels than our own get their own OBS picture and shuffle order
+        self.__obs_pic_location = f'stashiobot_pic_{channel}' if channel else 'stashiobot_pic'
         self.__stashio_pic_folder = 'stashio_pictures'
-        self.__image_handler = ImageHandler(self.__obs_pic_location, self.__stashio_pic_folder)
+        self.__pic_index_path = f'stashio_pictures_{channel}_index.json' if channel else None
+        # with a port the picture is served from memory for an OBS browser
+        # source instead of being written to stashiobot_pic
+        self.__picture_server = PictureServer(port=picture_server_port) if picture_server_port else None
+        # created on first use, it scans and watches the pictures folder
+        self.__image_handler = None
     
-        self.__voice = tts.TTS()
+        # TTS can be shared between channels, there's only one set of speakers
+        self.__voice = voice or tts.TTSQueue(backend=tts_backend)
+        # refunds redemptions that were dropped, without it they're only logged
+        self.__helix = helix
+        self.__refunds = set()
         self.__channel_rewards = {
             '79d9ed5c-6f65-4b81-8c27-71a9f3d7b181':
             {
                 'Name': 'TTS',
-                'Callback': self.__callback_TTS
+                'Callback': self.__callback_TTS,
+                'Concurrency': 1
             },
             'e86c82b1-0d47-4f18-aa00-d6f9c764e4d4':
             {
                 'Name': 'Change Stashio pic',
-                'Callback': self.__callback_Change_Pic
+                'Callback': self.__callback_Change_Pic,
+                'Concurrency': 1
             }
         }
+        
+        # each reward runs off its own queue, a slow TTS never holds up a pic change
+        self.__executors = { reward_id: RewardExecutor(reward['Name'], reward['Callback'], reward['Concurrency']) for reward_id, reward in self.__channel_rewards.items() }
+        # a redemption arrives both as raw pubsub and as a channel points event
+        self.__seen_redemptions = RecentIds(1024)
+        self.num_duplicates = 0
     
     ###########################################################################
     # Callbacks
     ###########################################################################
-    def __callback_TTS(self, user, message):
+    def __callback_TTS(self, user, message, redemption):
         voice_id, message = self.__parse_voice_id_and_message(message)
         print(f'TTS from {user}: {message}')
         
         tts_message = '{user} says... {message}'.format(user=user, message=message)
-        self.__speak_tts_blocking(voice_id, tts_message)
+        self.__voice.enqueue(voice_id, tts_message, on_drop=lambda job: self.__on_tts_dropped(user, redemption))
         
-    def __callback_Change_Pic(self, user, message):
+    def __callback_Change_Pic(self, user, message, redemption):
         print(f'Stashio pic changed by {user}')
-        self.__image_handler.next_pic()
+        self.__get_image_handler().next_pic()
     
     ###########################################################################
     # Public facing methods
     ###########################################################################            
-    def handle_pubsub_reward(self, reward_id, user, message):
-        if reward_id in self.__channel_rewards:
-            reward = self.__channel_rewards[reward_id]
-            reward['Callback'](user, message)
+    async def start(self):
+        if self.__picture_server:
+            await self.__picture_server.start()
+            self.__get_image_handler().show_current_pic()
+            
+    def get_tts_status(self):
+        return self.__voice.status()
+        
+    def get_reward_stats(self):
+        lines = [f'duplicate redemptions skipped: {self.num_duplicates}']
+        lines += [executor.summary() for executor in self.__executors.values()]
+        return '\n'.join(lines)
+        
+    def handle_pubsub_reward(self, reward_id, user, message, redemption_id=None, channel_id=None):
+        if redemption_id and not self.__seen_redemptions.add(redemption_id):
+            self.num_duplicates += 1
+            return False
+            
+        if reward_id in self.__executors:
+            # (channel id, reward id, redemption id), what a refund needs
+            redemption = (channel_id, reward_id, redemption_id) if channel_id and redemption_id else None
+            if self.__executors[reward_id].submit(user, message, redemption):
+                return True
+            self.__refund(redemption)
+            return False
         else:
             print(f"Channel reward '{reward_id}' not found.")
+            return False
             
     ###########################################################################
     # Private helper methods
     ###########################################################################
+    def __get_image_handler(self):
+        if not self.__image_handler:
+            self.__image_handler = ImageHandler(self.__obs_pic_location, self.__stashio_pic_folder, picture_server=self.__picture_server, index_path=self.__pic_index_path)
+        return self.__image_handler
+        
     def __parse_voice_id_and_message(self, message):
         r = re.findall(r'\<(\d)\>(.*)', message)
         voice_id = -1
@@ -59,5 +107,14 @@ class ChannelRewards():
             
         return voice_id, message
         
-    def __speak_tts_blocking(self, voice_id, tts_message):
-        self.__voice.speak_tts_blocking(voice_id, tts_message)
\ No newline at end of file
+    def __on_tts_dropped(self, user, redemption):
+        print(f'TTS queue is full, dropped the message from {user}.')
+        self.__refund(redemption)
+        
+    def __refund(self, redemption):
+        if not self.__helix or not redemption:
+            return
+        # keep a reference until it's done so the task isn't collected early
+        task = asyncio.get_running_loop().create_task(self.__helix.cancel_redemption(*redemption))
+        self.__refunds.add(task)
+        task.add_done_callback(self.__refunds.discard)
\ No newline at end of file
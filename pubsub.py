@@ -1,9 +1,9 @@
-import json
 import requests
 import random
 from twitchio.ext import pubsub
 from enum import Enum
-from utils.jsonparse import JsonParse
+from utils.jsonparse import loads
+from utils.helix import HelixClient
 
 class PubSubReturn(Enum):
     Success = 0
@@ -11,31 +11,126 @@ class PubSubReturn(Enum):
     BadAuth = 2
     UnknownError = 3
 
+class RewardRedemption():
+    __slots__ = ('redemption_id', 'channel_id', 'reward_id', 'user', 'message')
+    
+    def __init__(self, redemption_id, channel_id, reward_id, user, message):
+        self.redemption_id = redemption_id
+        self.channel_id = channel_id
+        self.reward_id = reward_id
+        self.user = user
+        self.message = message
+        
+def decode_reward_redemption(message):
+    # Pulls everything a redemption needs out of a pubsub channel points
+    # message in one pass, None if it's some other kind of message
+    parsed = loads(message)
+    if parsed.get('type') != 'reward-redeemed':
+        return None
+        
+    redemption = (parsed.get('data') or {}).get('redemption') or {}
+    user = redemption.get('user') or {}
+    reward = redemption.get('reward') or {}
+    return RewardRedemption(redemption.get('id'), redemption.get('channel_id'), reward.get('id'), user.get('login'), redemption.get('user_input'))
+    
+class AuthPubSubPool(pubsub.PubSubPool):
+    # Hands out the current access token whenever a connection comes back so
+    # a reconnect after a refresh doesn't have to fail first, and refreshes
+    # and resubscribes if Twitch rejects a token because it really expired.
+    # Twitch allows 50 topics per connection and 10 connections per IP.
+    MaxConnectionTopics = 50
+    MaxConnections = 10
+    # refreshes in a row without a successful subscribe before giving up
+    MaxAuthRetries = 3
+    
+    def __init__(self, client, auth):
+        super().__init__(client, max_pool_size=AuthPubSubPool.MaxConnections, max_connection_topics=AuthPubSubPool.MaxConnectionTopics)
+        self.__auth = auth
+        self.__auth_retries = 0
+        
+    def auth_succeeded(self):
+        self.__auth_retries = 0
+        
+    def _find_node(self, topics):
+        # twitchio's own check never finds room on an existing connection, so
+        # every subscribe would open a new one. Fill connections up instead.
+        for node in self._pool:
+            if len(node.topics) + len(topics) <= node.max_topics:
+                return node
+        if len(self._pool) < self._max_size:
+            return None
+        raise pubsub.models.PoolFull(f'The pubsub pool is full, unable to add {len(topics)} topics.')
+        
+    async def reconnect_hook(self, node, topics):
+        token = await self.__auth.get_valid_access_token()
+        for topic in topics:
+            topic.token = token
+        return topics
+        
+    async def auth_fail_hook(self, topics):
+        if not topics:
+            return
+        # a still valid token was rejected for some other reason (missing
+        # scope, someone else's channel), refreshing would never fix that
+        if await self.__auth.validate_access_token(force=True):
+            print(f'Not resubscribing to {len(topics)} topic(s), the access token is valid but was rejected.')
+            return
+        if self.__auth_retries >= AuthPubSubPool.MaxAuthRetries:
+            print(f'Giving up on {len(topics)} topic(s) after {self.__auth_retries} token refreshes.')
+            return
+        self.__auth_retries += 1
+        token = await self.__auth.refresh_access_token()
+        for topic in topics:
+            topic.token = token
+        await self.subscribe_topics(topics)
+        
 class PubSubHandler():
-    def __init__(self, twitch_bot, auth, channels):
+    def __init__(self, twitch_bot, auth, channels, helix=None):
         self.__twitch_bot = twitch_bot
         self.__auth = auth
         self.__channels = channels
-        self.__pubsub = pubsub.PubSubPool(self.__twitch_bot)
+        self.__pubsub = AuthPubSubPool(self.__twitch_bot, self.__auth)
+        self.__helix = helix or HelixClient(self.__auth)
         
     ###########################################################################
     # Public facing methods
     ###########################################################################    
-    async def subscribe_for_channel_rewards(self, auth_token, channel_name):
-        channel_ids = self.__get_channel_ids([channel_name])
-        await self.__pubsub.subscribe_topics([pubsub.channel_points(auth_token)[int(channel_ids[0])]])
+    async def subscribe_for_channel_rewards(self, auth_token, token_user, channel_names):
+        # returns login -> channel id for every channel subscribed to.
+        # Twitch only takes a channel's channel points topic with the
+        # broadcaster's own token, and twitchio sends every topic sharing a
+        # token in one LISTEN, so a single other channel would get ours
+        # rejected too. Only the channel the token belongs to is subscribed.
+        token_user = token_user.lower()
+        subscribable = [name for name in channel_names if name.lower() == token_user]
+        for channel_name in channel_names:
+            if channel_name.lower() != token_user:
+                print(f"No access token for '{channel_name}', not subscribing to its channel rewards.")
+        if not subscribable:
+            return {}
+            
+        user_ids = await self.__helix.get_user_ids(subscribable)
+        for channel_name in subscribable:
+            if channel_name.lower() not in user_ids:
+                print(f"Couldn't find the Twitch user '{channel_name}', not subscribing to its channel rewards.")
+                
+        for channel_id in user_ids.values():
+            await self.__pubsub.subscribe_topics([pubsub.channel_points(auth_token)[int(channel_id)]])
+        return user_ids
         
-    async def handle_rewards(self, data, rewards):
+    async def handle_rewards(self, data, get_rewards):
+        # get_rewards(channel_id) gives the ChannelRewards for the channel redeemed in
         if not 'type' in data:
             return PubSubReturn.UnknownError
             
         if data['type'] == "RESPONSE":
             if data['error'] == '':
+                self.__pubsub.auth_succeeded()
                 print("PubSub enabled.")
             elif data['error'] == 'ERR_BADAUTH':
-                if not self.__auth.validate_access_token():
-                    self.__auth.refresh_access_token()
-                    print('Your access token has expired. The token has been refreshed.')
+                # the pool refreshes the token and resubscribes on its own
+                if not await self.__auth.validate_access_token(force=True):
+                    print('Your access token has expired. Refreshing it and resubscribing.')
                     return PubSubReturn.ExpiredAccessToken
                 else:
                     print('Received ERR_BADAUTH but access token has not expired. Are you subscribing to the wrong channel?')
@@ -45,14 +140,11 @@ class PubSubHandler():
                 return PubSubReturn.UnknownError
                 
         elif data['type'] == "MESSAGE":
-            parse = JsonParse(json.loads(data['data']['message']))
-            if parse.get('type') == "reward-redeemed":
-                user = parse.get('data/redemption/user/login')
-                reward = parse.get('data/redemption/reward')
-                message = parse.get('data/redemption/user_input')
-                reward_id = parse.get('data/redemption/reward/id')
-                
-                rewards.handle_pubsub_reward(reward_id, user, message)
+            redemption = decode_reward_redemption(data['data']['message'])
+            if redemption:
+                rewards = get_rewards(redemption.channel_id)
+                if rewards:
+                    rewards.handle_pubsub_reward(redemption.reward_id, redemption.user, redemption.message, redemption.redemption_id, redemption.channel_id)
                 
         return PubSubReturn.Success
             
@@ -64,17 +156,12 @@ class PubSubHandler():
         r = requests.post(url)
         print(r.content)
         
-    def __get_channel_ids(self, channels):
-        headers = {
-            'Client-ID': self.__auth.get_client_id(),
-            'Authorization': f'Bearer {self.__auth.get_access_token()}'
-        }
-        r = requests.get(f'https://api.twitch.tv/helix/users?login={"&topic=".join(channels)}', headers=headers)
-        j = json.loads(r.content)
-        return [j['data'][i]['id'] for i in range(len(channels))]
+    async def __get_channel_ids(self, channels):
+        user_ids = await self.__helix.get_user_ids(channels)
+        return [user_ids[channel.lower()] for channel in channels if channel.lower() in user_ids]
         
-    def __get_channel_reward_topics(self, channels):
-        channel_ids = self.__get_channel_ids(channels)
+    async def __get_channel_reward_topics(self, channels):
+        channel_ids = await self.__get_channel_ids(channels)
         return [f'channel-points-channel-v1.{channel}' for channel in channel_ids]
         
     def __generate_nonce(length=8):
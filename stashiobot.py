@@ -1,34 +1,57 @@
 import signal
+import argparse
 import random
 import asyncio, concurrent.futures
-import requests
 from concurrent.futures import ThreadPoolExecutor
 from twitchio.ext import commands
 import twitchio
 from auth import Auth
 from channel_rewards import ChannelRewards
+from channel_context import ChannelContext
 from pubsub import PubSubHandler, PubSubReturn
 from supermetroidmanager import SuperMetroidRunManager, SuperMetroidCallbacks
 from utils.language import MessageTranslator
+from utils.chatmessage import tokenize_message
+from utils.funtoon import FuntoonDispatcher
+from utils.helix import HelixClient
+from utils.ratelimit import RateLimiter
+from utils.tts import TTSQueue
 from utils.supermetroid import SuperMetroid, Rooms
 
 class Bot(commands.Bot):
-    def __init__(self):
+    def __init__(self, picture_server_port=None):
         self.initial_channels = [
             'stashiocat'
         ]
+        # the first channel is ours, the Super Metroid run state is reported
+        # to it and, given a port, it serves its picture from the local
+        # picture server instead of the stashiobot_pic file
+        self.sm_channel = self.initial_channels[0].lower()
+        self.command_prefix = '!'
         
         self.auth = Auth('auth.json')
     
+        # only our own channel is joined on connect, the rest are joined at
+        # Twitch's JOIN rate limit once we're ready
         super().__init__(
             token=self.auth.get_irc_token(),
             nick=self.auth.get_user(),
-            prefix='!',
-            initial_channels=self.initial_channels
+            prefix=self.command_prefix,
+            initial_channels=[self.sm_channel]
         )
 
-        self.rewards = ChannelRewards()
-        self.pubsub = PubSubHandler(self, self.auth, self.initial_channels)
+        self.channels = { name.lower(): ChannelContext(name.lower()) for name in self.initial_channels }
+        self.channels_by_id = {}
+        # Funtoon knows our channel by the account we log in as
+        self.channels[self.sm_channel].funtoon_channel = self.auth.get_user()
+        self.join_limiter = RateLimiter(20, 10.0)
+        self.join_task = None
+        self.is_subscribed = False
+        
+        self.voice = TTSQueue()
+        self.helix = HelixClient(self.auth)
+        self.channels[self.sm_channel].rewards = ChannelRewards(picture_server_port=picture_server_port, voice=self.voice, helix=self.helix)
+        self.pubsub = PubSubHandler(self, self.auth, self.initial_channels, self.helix)
         self.translator = MessageTranslator()
         
         sm_callbacks = SuperMetroidCallbacks(
@@ -43,28 +66,28 @@ class Bot(commands.Bot):
                     ceres_timer        = self.ceres_timer,
                 )
         self.sm_manager = SuperMetroidRunManager(sm_callbacks)
-        self.sm_games = True
-        self.is_phan_open = False
-        self.is_ceres_open = False
-        self.is_ceres_timer_ready = False
+        self.funtoon = FuntoonDispatcher('https://funtoon.party/api/events/custom', self.auth)
         self.pool_executor = concurrent.futures.ThreadPoolExecutor()
         
     def enable_threads(self, loop):
         loop.create_task(input_thread(self))
         self.sm_manager.enable_threads(loop)
 
-    def funtoon_custom_event(self, event_name, event_data=None):
-        if self.sm_games:
-            headers = {
-                'Authorization': self.auth.get_funtoon_token(),
-                'Content-Type': 'Application/json'
-            }
-            content_data = {
-                'channel': self.auth.get_user(),
-                'event': event_name,
-                'data': event_data
-            }
-            r = requests.post('https://funtoon.party/api/events/custom', headers=headers, json=content_data)
+    def get_rewards(self, channel):
+        if not channel.rewards:
+            channel.rewards = ChannelRewards(channel=channel.name, voice=self.voice, helix=self.helix)
+        return channel.rewards
+        
+    def get_rewards_for_channel_id(self, channel_id):
+        name = self.channels_by_id.get(str(channel_id))
+        if not name:
+            print(f"Got a redemption for unknown channel id '{channel_id}'")
+            return None
+        return self.get_rewards(self.channels[name])
+        
+    def funtoon_custom_event(self, channel, event_name, event_data=None):
+        if channel.sm_games:
+            self.funtoon.post(channel.funtoon_channel, event_name, event_data)
 
     def run_started(self):
         print('Run started')
@@ -73,57 +96,85 @@ class Bot(commands.Bot):
         print('Run reset')
         
     def enter_phantoon(self):
-        if self.is_phan_open:
-            self.is_phan_open = False
-            self.funtoon_custom_event('phanclose')
+        channel = self.channels[self.sm_channel]
+        if channel.is_phan_open:
+            channel.is_phan_open = False
+            self.funtoon_custom_event(channel, 'phanclose')
         
     def enter_moat(self):
-        if not self.is_phan_open:
-            self.is_phan_open = True
-            self.funtoon_custom_event('phanopen')
+        channel = self.channels[self.sm_channel]
+        if not channel.is_phan_open:
+            channel.is_phan_open = True
+            self.funtoon_custom_event(channel, 'phanopen')
     
     def phantoon_fight_end(self, patterns):
-        self.funtoon_custom_event('phanend', ' '.join(patterns))
+        self.funtoon_custom_event(self.channels[self.sm_channel], 'phanend', ' '.join(patterns))
     
     def ceres_start(self):
-        if not self.is_ceres_open:
-            self.is_ceres_open = True
-            self.funtoon_custom_event('ceresopen')
+        channel = self.channels[self.sm_channel]
+        if not channel.is_ceres_open:
+            channel.is_ceres_open = True
+            self.funtoon_custom_event(channel, 'ceresopen')
         
     def ceres_end(self):
-        if self.is_ceres_open:
-            self.is_ceres_open = False
-            self.is_ceres_timer_ready = True
-            self.funtoon_custom_event('ceresclose')
+        channel = self.channels[self.sm_channel]
+        if channel.is_ceres_open:
+            channel.is_ceres_open = False
+            channel.is_ceres_timer_ready = True
+            self.funtoon_custom_event(channel, 'ceresclose')
             
     def ceres_timer(self, time):
-        if self.is_ceres_timer_ready:
-            self.is_ceres_timer_ready = False
-            self.funtoon_custom_event('ceresend', hex(time)[2::])
+        channel = self.channels[self.sm_channel]
+        if channel.is_ceres_timer_ready:
+            channel.is_ceres_timer_ready = False
+            self.funtoon_custom_event(channel, 'ceresend', hex(time)[2::])
             
+    async def join_remaining_channels(self):
+        joined = { channel.name.lower() for channel in self.connected_channels if channel }
+        for name in self.channels:
+            if name not in joined:
+                await self.join_limiter.acquire()
+                await self.join_channels([name])
+                
     async def event_ready(self):
         print('Connected!')
-        await self.pubsub.subscribe_for_channel_rewards(self.auth.get_access_token(), self.initial_channels[0])
+        # this runs again after a reconnect, which only rejoins our own channel
+        if not self.join_task or self.join_task.done():
+            self.join_task = asyncio.get_running_loop().create_task(self.join_remaining_channels())
+        if self.is_subscribed:
+            return
+        self.is_subscribed = True
+        
+        await self.channels[self.sm_channel].rewards.start()
+        await self.auth.start()
+        token = await self.auth.get_valid_access_token()
+        token_user = self.auth.get_token_user() or self.auth.get_user()
+        user_ids = await self.pubsub.subscribe_for_channel_rewards(token, token_user, list(self.channels))
+        for name, channel_id in user_ids.items():
+            self.channels[name].channel_id = channel_id
+            self.channels_by_id[channel_id] = name
         
     async def event_raw_pubsub(self, data):
-        result = await self.pubsub.handle_rewards(data, self.rewards)
+        result = await self.pubsub.handle_rewards(data, self.get_rewards_for_channel_id)
 
     async def event_pubsub_channel_points(self, msg):
-        self.rewards.handle_pubsub_reward(msg.reward.id, msg.user.name, msg.input)
+        rewards = self.get_rewards_for_channel_id(msg.channel_id)
+        if rewards:
+            rewards.handle_pubsub_reward(msg.reward.id, msg.user.name, msg.input, msg.id, str(msg.channel_id))
     
     async def event_token_expired(self):
-        return self.__auth.refresh_access_token()
+        return await self.auth.refresh_access_token()
     
     async def event_message(self, message):
         if message.author and message.author.name.lower() != self.nick.lower():
-            prefix = await self.get_prefix(message)
-            if not prefix:
-                src, dst, msg = self.translator.chat_auto_translate(message)
-                if src and dst and msg and (msg != message.content):
-                    await message.channel.send(f'{src} => {dst}: {msg}')
-                    return
-                 
-            await self.handle_commands(message)
+            tokens = tokenize_message(message, self.command_prefix)
+            if tokens.is_command:
+                await self.handle_commands(message)
+                return
+                
+            src, dst, msg = await self.translator.chat_auto_translate(tokens, message.author.name)
+            if src and dst and msg and (msg != message.content):
+                await message.channel.send(f'{src} => {dst}: {msg}')
 
     async def event_raw_data(self, data):
         #print(data)
@@ -153,12 +204,37 @@ async def input_thread(bot):
         if len(inp) > 0 and inp[0] == '/':
             inp = inp[1::]
             if inp.lower() == "smtoggle":
-                bot.sm_games = not bot.sm_games
-                print(f'Super Metroid games are now {"on" if bot.sm_games else "off"}')
+                channel = bot.channels[bot.sm_channel]
+                channel.sm_games = not channel.sm_games
+                print(f'Super Metroid games are now {"on" if channel.sm_games else "off"}')
+            elif inp.lower() == "ttsstatus":
+                print(bot.voice.status())
+            elif inp.lower() == "channels":
+                joined = { channel.name.lower() for channel in bot.connected_channels if channel }
+                print(f'{len(joined)}/{len(bot.channels)} channels joined, {len(bot.channels_by_id)} subscribed to channel rewards')
+            elif inp.lower() == "rewardstats":
+                print(bot.get_rewards(bot.channels[bot.sm_channel]).get_reward_stats())
+            elif inp.lower() == "funtoonstats":
+                print(bot.funtoon.summary())
+            elif inp.lower() == "eventstats":
+                print(bot.sm_manager.get_event_stats())
+            elif inp.lower() == "pollstats":
+                print(bot.sm_manager.get_poll_stats().summary())
+            elif inp.lower().startswith("record "):
+                path = inp[len("record "):].strip()
+                bot.sm_manager.start_recording(path)
+                print(f'Recording memory snapshots to {path}')
+            elif inp.lower() == "stoprecord":
+                bot.sm_manager.stop_recording()
+                print('Stopped recording memory snapshots')
     
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--picture-server-port', type=int, default=None, help='serve the channel picture on this port for an OBS browser source')
+    args = parser.parse_args()
+    
     # make Ctrl-C actually kill the process
-    bot = Bot()
+    bot = Bot(picture_server_port=args.picture_server_port)
     loop = asyncio.get_event_loop()
     loop.create_task(input_thread(bot))
     bot.run()
@@ -3,7 +3,7 @@ import asyncio
 import json
 from dataclasses import dataclass
 from typing import Any, Callable
-from utils.supermetroid import SuperMetroid, Rooms, PhantoonPatterns, GameStates
+from utils.supermetroid import SuperMetroid, Rooms, PhantoonPatterns, GameStates, PollRates
 
 @dataclass
 class SuperMetroidCallbacks():
@@ -41,20 +41,28 @@ class SuperMetroidRunManager():
         Intro = 1
         Escape = 2
         
-    def __init__(self, in_callbacks):
-        self.__sm = SuperMetroid()
+    # Fields polled every frame while they matter
+    PhantoonBurstFields = ['enemy_hp', 'phantoon_eye_timer']
+    CeresBurstFields    = ['ceres_timer', 'ceres_state', 'game_state']
+        
+    def __init__(self, in_callbacks, qusb2snes_host='localhost', qusb2snes_port=8080):
+        self.__sm = SuperMetroid(qusb2snes_host, qusb2snes_port)
         self.__callbacks = in_callbacks
         
-        # Internal subscriptions
-        self.__sm.subscribe(SuperMetroid.Callbacks.RunStarted , self.__run_started)
-        self.__sm.subscribe(SuperMetroid.Callbacks.RunReset   , self.__run_reset)
-        self.__sm.subscribe(SuperMetroid.Callbacks.EnemyHP    , self.__enemy_hp)
-        self.__sm.subscribe(SuperMetroid.Callbacks.SamusHP    , self.__samus_hp)
-        self.__sm.subscribe(SuperMetroid.Callbacks.PhantoonEye, self.__phantoon_eye_timer)
-        self.__sm.subscribe(SuperMetroid.Callbacks.CeresTimer , self.__ceres_timer)
-        self.__sm.subscribe(SuperMetroid.Callbacks.GameState  , self.__game_state)
-        self.__sm.subscribe_to_room_transition(Rooms.WreckedShip.Basement, Rooms.WreckedShip.Phantoon, self.__enter_phantoon)
-        self.__sm.subscribe_to_room_transition(Rooms.Crateria.Kihunter   , Rooms.Crateria.Moat       , self.__enter_moat)
+        # Internal subscriptions, all on one subscriber so the run state sees
+        # events in the order they happened
+        self.__sm.subscribe_many({
+            SuperMetroid.Callbacks.RunStarted : self.__run_started,
+            SuperMetroid.Callbacks.RunReset   : self.__run_reset,
+            SuperMetroid.Callbacks.EnemyHP    : self.__enemy_hp,
+            SuperMetroid.Callbacks.SamusHP    : self.__samus_hp,
+            SuperMetroid.Callbacks.PhantoonEye: self.__phantoon_eye_timer,
+            SuperMetroid.Callbacks.CeresTimer : self.__ceres_timer,
+            SuperMetroid.Callbacks.GameState  : self.__game_state,
+            SuperMetroid.room_transition_event(Rooms.WreckedShip.Basement, Rooms.WreckedShip.Phantoon): self.__enter_phantoon,
+            SuperMetroid.room_transition_event(Rooms.Crateria.Kihunter   , Rooms.Crateria.Moat       ): self.__enter_moat,
+            SuperMetroid.memory_update_event(SuperMetroid.MemoryUpdates.Ceres): self.__ceres_update,
+        }, max_queue=4096, name='run manager')
         
         self.__in_run = False
         
@@ -71,6 +79,21 @@ class SuperMetroidRunManager():
     def enable_threads(self, loop):
         return self.__sm.enable_threads(loop)
         
+    def get_poll_stats(self):
+        return self.__sm.get_poll_stats()
+        
+    def get_event_stats(self):
+        return self.__sm.get_event_stats()
+        
+    def start_recording(self, path):
+        self.__sm.start_recording(path)
+        
+    def stop_recording(self):
+        self.__sm.stop_recording()
+        
+    async def replay(self, path):
+        return await self.__sm.replay(path)
+        
     ###########################################################################
     # Internal private callbacks
     ###########################################################################
@@ -79,6 +102,8 @@ class SuperMetroidRunManager():
         
     async def __run_reset(self):
         self.__in_run = False
+        self.__set_poll_burst(SuperMetroidRunManager.PhantoonBurstFields, False)
+        self.__set_poll_burst(SuperMetroidRunManager.CeresBurstFields, False)
         if self.__ceres_state == SuperMetroidRunManager.CeresState.Escape:
             self.__ceres_state = SuperMetroidRunManager.CeresState.NotInCeres
             
@@ -91,6 +116,8 @@ class SuperMetroidRunManager():
     async def __enter_phantoon(self):
         if self.__in_run and not self.__phantoon_dead:
             self.__in_phantoon_room = True
+            # the first eye timer value is only around for a few frames
+            self.__set_poll_burst(SuperMetroidRunManager.PhantoonBurstFields, True)
         
     async def __enter_moat(self):
         if self.__in_run and not self.__phantoon_dead:
@@ -108,6 +135,7 @@ class SuperMetroidRunManager():
                 if hp == 0:
                     self.__in_phantoon_fight = False
                     self.__in_phantoon_room = False
+                    self.__set_poll_burst(SuperMetroidRunManager.PhantoonBurstFields, False)
                     if self.__callbacks.phantoon_fight_end:
                         self.__callbacks.phantoon_fight_end(self.__phantoon_patterns)
                 elif len(self.__phantoon_patterns) == self.__current_phantoon_round:
@@ -122,6 +150,7 @@ class SuperMetroidRunManager():
                 self.__in_phantoon_room = False
                 self.__phantoon_dead = True
                 self.__phantoon_patterns = []
+                self.__set_poll_burst(SuperMetroidRunManager.PhantoonBurstFields, False)
                 if self.__callbacks.phantoon_fight_end:
                     self.__callbacks.phantoon_fight_end(['death'])
     
@@ -137,13 +166,21 @@ class SuperMetroidRunManager():
     async def __ceres_timer(self, time, is_final):
         if self.__ceres_state == SuperMetroidRunManager.CeresState.Escape and is_final and self.__callbacks.ceres_timer:
             self.__callbacks.ceres_timer(time)
-            self.__sm.unsubscribe_to_memory_update(SuperMetroid.MemoryUpdates.Ceres, self.__ceres_update)
+            self.__sm.unsubscribe_to_memory_update(SuperMetroid.MemoryUpdates.Ceres)
             self.__ceres_state = SuperMetroidRunManager.CeresState.NotInCeres
+            self.__set_poll_burst(SuperMetroidRunManager.CeresBurstFields, False)
             
 
     ###########################################################################
     # Private helper functions
     ###########################################################################
+    def __set_poll_burst(self, fields, enabled):
+        for field in fields:
+            if enabled:
+                self.__sm.set_poll_rate(field, PollRates.EveryFrame)
+            else:
+                self.__sm.clear_poll_rate(field)
+                
     def __get_phantoon_pattern(self, timer):
         if timer <= PhantoonPatterns.Fast:
             return 'fast'
@@ -155,6 +192,7 @@ class SuperMetroidRunManager():
     async def __ceres_update(self, ceres_data):
         if self.__ceres_state == SuperMetroidRunManager.CeresState.Intro and ceres_data['ceres_state'] == SuperMetroidRunManager.CeresState.Escape:
             self.__ceres_state = SuperMetroidRunManager.CeresState.Escape
+            self.__set_poll_burst(SuperMetroidRunManager.CeresBurstFields, True)
             if self.__callbacks.ceres_end:
                 self.__callbacks.ceres_end()
                 
@@ -167,9 +205,10 @@ class SuperMetroidRunManager():
         self.__current_phantoon_round = 0
         self.__phantoon_patterns = []
         self.__in_run = True
+        self.__set_poll_burst(SuperMetroidRunManager.PhantoonBurstFields, False)
         
         if self.__callbacks.ceres_timer:
-            self.__sm.subscribe_to_memory_update(SuperMetroid.MemoryUpdates.Ceres, self.__ceres_update)
+            self.__sm.subscribe_to_memory_update(SuperMetroid.MemoryUpdates.Ceres)
         
         if self.__callbacks.ceres_start and self.__ceres_state is not SuperMetroidRunManager.CeresState.Intro:
             self.__callbacks.ceres_start()
@@ -0,0 +1,102 @@
+import re
+
+EMOTE_PLACEHOLDER_REGEX = re.compile(r'__(\w+?)__')
+
+class TokenizedMessage():
+    # A chat message parsed once into its text and emote spans, shared
+    # by command dispatch, the translator and any other filters
+    __slots__ = ('content', 'emotes', 'is_command', 'is_emote_only', '__stripped', '__emote_text')
+    
+    def __init__(self, content, emotes, prefix=None):
+        self.content = content
+        # (start, end, emote id) sorted by position, end is exclusive
+        self.emotes = emotes
+        self.is_command = content.startswith(prefix) if prefix else False
+        self.__emote_text = None
+        
+        # most messages have no emote or just one, skip the span walk for those
+        if not emotes:
+            self.__stripped = content
+            self.is_emote_only = False
+            return
+        self.__stripped = None
+        if len(emotes) == 1:
+            start, end, _ = emotes[0]
+            self.is_emote_only = (start == 0 or content[:start].isspace()) and (end == len(content) or content[end:].isspace())
+            return
+            
+        is_emote_only = True
+        pos = 0
+        for start, end, _ in emotes:
+            if pos != start and not content[pos:start].isspace():
+                is_emote_only = False
+                break
+            pos = end
+        self.is_emote_only = is_emote_only and (pos == len(content) or content[pos:].isspace())
+        
+    def stripped_text(self):
+        # the text with every emote replaced by a __id__ placeholder
+        if self.__stripped is None:
+            if not self.emotes:
+                self.__stripped = self.content
+            elif len(self.emotes) == 1:
+                start, end, emote_id = self.emotes[0]
+                self.__stripped = f'{self.content[:start]}__{emote_id}__{self.content[end:]}'
+            else:
+                content = self.content
+                parts = []
+                pos = 0
+                for start, end, emote_id in self.emotes:
+                    parts.append(content[pos:start])
+                    parts.append(f'__{emote_id}__')
+                    pos = end
+                parts.append(content[pos:])
+                self.__stripped = ''.join(parts)
+        return self.__stripped
+        
+    def emote_text(self):
+        # emote id -> how the emote was written in chat
+        if self.__emote_text is None:
+            self.__emote_text = dict()
+            for start, end, emote_id in self.emotes:
+                if emote_id not in self.__emote_text:
+                    self.__emote_text[emote_id] = self.content[start:end]
+        return self.__emote_text
+        
+    def restore_emotes(self, text):
+        # put the emotes back into a (translated) stripped text
+        if not self.emotes:
+            return text
+        if len(self.emotes) == 1:
+            start, end, emote_id = self.emotes[0]
+            return text.replace(f'__{emote_id}__', self.content[start:end])
+        # every placeholder in a single pass however many distinct emotes
+        # there are, the odd parts of the split are the emote ids
+        emote_text = self.emote_text()
+        parts = EMOTE_PLACEHOLDER_REGEX.split(text)
+        parts[1::2] = [emote_text.get(emote_id, f'__{emote_id}__') for emote_id in parts[1::2]]
+        return ''.join(parts)
+
+def tokenize_message(message, prefix=None):
+    tags = message.tags
+    emotes_tag = tags.get('emotes') if tags else None
+    return TokenizedMessage(message.content, parse_emotes_tag(emotes_tag) if emotes_tag else [], prefix)
+
+def parse_emotes_tag(emotes_tag):
+    # IRC emotes tag: 'id:start-end,start-end/id:start-end', end inclusive
+    if not emotes_tag:
+        return []
+    if '/' not in emotes_tag and ',' not in emotes_tag:
+        # a single emote used once
+        emote_id, _, splice = emotes_tag.partition(':')
+        start, _, end = splice.partition('-')
+        return [(int(start), int(end) + 1, emote_id)]
+        
+    emotes = []
+    for emote in emotes_tag.split('/'):
+        emote_id, _, ranges = emote.partition(':')
+        for splice in ranges.split(','):
+            start, _, end = splice.partition('-')
+            emotes.append((int(start), int(end) + 1, emote_id))
+    emotes.sort()
+    return emotes
@@ -0,0 +1,134 @@
+import asyncio
+import inspect
+
+class Overflow():
+    # What a subscriber does with a new event when its queue is full
+    DropOldest = 0
+    DropNewest = 1
+
+class Subscriber():
+    # Handlers for one or more event types sharing a single bounded queue and
+    # task, so the events reach them in exactly the order they were published
+    # no matter the type. Handlers can be plain functions or coroutines.
+    def __init__(self, handlers, max_queue, overflow, name):
+        self.handlers = handlers
+        self.name = name
+        self.__overflow = overflow
+        self.__queue = asyncio.Queue(maxsize=max_queue)
+        self.__task = None
+        
+        self.max_queue_depth = 0
+        self.num_delivered = 0
+        self.num_failed = 0
+        self.num_dropped = 0
+    
+    ###########################################################################
+    # Public facing methods
+    ###########################################################################
+    def offer(self, event_type, args):
+        # Never waits, the publisher is the poll loop
+        self.__ensure_task()
+        
+        if self.__queue.full():
+            self.num_dropped += 1
+            if self.__overflow == Overflow.DropNewest:
+                return False
+            self.__queue.get_nowait()
+            self.__queue.task_done()
+        
+        self.__queue.put_nowait((event_type, args))
+        self.max_queue_depth = max(self.max_queue_depth, self.__queue.qsize())
+        return True
+    
+    def queue_depth(self):
+        return self.__queue.qsize()
+    
+    async def drain(self):
+        await self.__queue.join()
+    
+    def close(self):
+        if self.__task:
+            self.__task.cancel()
+            self.__task = None
+    
+    def summary(self):
+        return f'{self.name}: delivered: {self.num_delivered}, failed: {self.num_failed}, dropped: {self.num_dropped}, queue depth: {self.queue_depth()} (max {self.max_queue_depth})'
+    
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __ensure_task(self):
+        if not self.__task or self.__task.done():
+            self.__task = asyncio.get_running_loop().create_task(self.__run())
+    
+    async def __run(self):
+        while True:
+            event_type, args = await self.__queue.get()
+            try:
+                result = self.handlers[event_type](*args)
+                if inspect.isawaitable(result):
+                    await result
+                self.num_delivered += 1
+            except Exception as e:
+                self.num_failed += 1
+                print(f"Event subscriber '{self.name}' failed on {event_type}: {e}")
+            finally:
+                self.__queue.task_done()
+
+class EventBus():
+    # Fans every published event out to all of its subscribers. Publishing
+    # only puts the event on each subscriber's queue, so a slow subscriber
+    # can fall behind (and drop events once its queue is full) but never
+    # holds up the publisher or the other subscribers.
+    def __init__(self):
+        self.__subscribers = []
+        self.__by_type = dict()
+        # subscribers published to since the last drain
+        self.__published_to = set()
+    
+    ###########################################################################
+    # Public facing methods
+    ###########################################################################
+    def subscribe(self, handlers, max_queue=256, overflow=Overflow.DropOldest, name=None):
+        # handlers maps event type -> callback
+        subscriber = Subscriber(dict(handlers), max_queue, overflow, name or f'subscriber {len(self.__subscribers)}')
+        self.__subscribers.append(subscriber)
+        for event_type in subscriber.handlers:
+            self.__by_type.setdefault(event_type, []).append(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        if subscriber not in self.__subscribers:
+            return
+        self.__subscribers.remove(subscriber)
+        self.__published_to.discard(subscriber)
+        for event_type in subscriber.handlers:
+            self.__by_type[event_type].remove(subscriber)
+            if not self.__by_type[event_type]:
+                del self.__by_type[event_type]
+        subscriber.close()
+    
+    def has_subscribers(self, event_type):
+        return event_type in self.__by_type
+    
+    def event_types(self):
+        return self.__by_type.keys()
+    
+    def subscribers(self):
+        return list(self.__subscribers)
+    
+    def publish(self, event_type, *args):
+        for subscriber in self.__by_type.get(event_type, ()):
+            subscriber.offer(event_type, args)
+            self.__published_to.add(subscriber)
+    
+    async def drain(self):
+        while self.__published_to:
+            await self.__published_to.pop().drain()
+    
+    def close(self):
+        for subscriber in self.__subscribers:
+            subscriber.close()
+    
+    def summary(self):
+        return '\n'.join(subscriber.summary() for subscriber in self.__subscribers)
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import argparse
+import websockets
+
+# Stand-in for a QUsb2Snes/SNI server that speaks the same websocket JSON
+# protocol, backed by a scriptable 128 KB WRAM image. Used for transport
+# benchmarks and for running the bot without a console or emulator.
+
+class FakeQUsb2Snes():
+    WramBase = 0xF50000
+    WramSize = 0x20000
+    
+    def __init__(self, hostname='localhost', port=8080, devices=None, latency=0.0, per_byte_latency=0.0, fragment_size=None):
+        self.hostname = hostname
+        self.port = port
+        self.devices = devices if devices is not None else ['SD2SNES COM3']
+        self.wram = bytearray(FakeQUsb2Snes.WramSize)
+        
+        # seconds added to every reply, plus per byte of GetAddress data
+        self.latency = latency
+        self.per_byte_latency = per_byte_latency
+        # split binary replies into websocket frames of at most this many bytes
+        self.fragment_size = fragment_size
+        
+        self.num_requests = 0
+        self.__disconnect_after = None
+        self.__server = None
+        self.__clients = set()
+        
+    async def __aenter__(self):
+        await self.start()
+        return self
+        
+    async def __aexit__(self, *args):
+        await self.stop()
+        
+    ###########################################################################
+    # Public facing methods
+    ###########################################################################
+    async def start(self):
+        self.__server = await websockets.serve(self.__handle_client, self.hostname, self.port)
+        # support port=0 by picking up whatever was bound
+        self.port = next(iter(self.__server.sockets)).getsockname()[1]
+        
+    async def stop(self):
+        if self.__server:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
+            
+    async def disconnect_clients(self):
+        for ws in list(self.__clients):
+            await ws.close()
+            
+    def disconnect_after(self, num_requests):
+        # drop every client once this many more requests were handled
+        self.__disconnect_after = self.num_requests + num_requests
+        
+    def poke(self, addr, value, size=2):
+        self.wram[addr:addr + size] = value.to_bytes(size, 'little')
+        
+    def peek(self, addr, size=2):
+        return int.from_bytes(self.wram[addr:addr + size], 'little')
+        
+    def write(self, addr, data):
+        self.wram[addr:addr + len(data)] = data
+        
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __handle_client(self, ws, *args):
+        self.__clients.add(ws)
+        try:
+            async for message in ws:
+                await self.__handle_command(ws, json.loads(message))
+                
+                self.num_requests += 1
+                if self.__disconnect_after is not None and self.num_requests >= self.__disconnect_after:
+                    self.__disconnect_after = None
+                    await self.disconnect_clients()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.__clients.discard(ws)
+            
+    async def __handle_command(self, ws, command):
+        opcode = command.get('Opcode')
+        operands = command.get('Operands', [])
+        
+        if opcode == 'DeviceList':
+            await self.__reply(ws, json.dumps({ 'Results': self.devices }))
+        elif opcode == 'Info':
+            await self.__reply(ws, json.dumps({ 'Results': ['1.10.3', 'FakeQUsb2Snes', 'Super Metroid', 'NO_ROM_WRITE'] }))
+        elif opcode == 'GetAddress':
+            data = b''.join(self.__read(int(addr, 16), int(size, 16)) for addr, size in zip(operands[::2], operands[1::2]))
+            await self.__reply(ws, data)
+        # Attach, Name etc. get no reply, same as the real thing
+        
+    async def __reply(self, ws, data):
+        delay = self.latency + (self.per_byte_latency * len(data) if isinstance(data, bytes) else 0)
+        if delay:
+            await asyncio.sleep(delay)
+            
+        if isinstance(data, bytes) and self.fragment_size:
+            for i in range(0, len(data), self.fragment_size):
+                await ws.send(data[i:i + self.fragment_size])
+        else:
+            await ws.send(data)
+            
+    def __read(self, addr, size):
+        offset = addr - FakeQUsb2Snes.WramBase
+        if 0 <= offset < FakeQUsb2Snes.WramSize:
+            data = bytes(self.wram[offset:offset + size])
+            return data + bytes(size - len(data))
+        return bytes(size)
+
+async def main():
+    parser = argparse.ArgumentParser(description='Fake QUsb2Snes server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every reply')
+    parser.add_argument('--fragment-size', type=int, default=None)
+    args = parser.parse_args()
+    
+    async with FakeQUsb2Snes(args.host, args.port, latency=args.latency, fragment_size=args.fragment_size) as server:
+        print(f'Fake QUsb2Snes listening on ws://{server.hostname}:{server.port}')
+        await asyncio.Future()
+
+if __name__ == '__main__':
+    asyncio.run(main())
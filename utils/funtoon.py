@@ -0,0 +1,123 @@
+import time
+import asyncio
+import aiohttp
+from utils.pollstats import Histogram
+
+class FuntoonDispatcher():
+    # Sends Funtoon custom events from a single background worker over a
+    # persistent keep-alive session. Events go out strictly in the order they
+    # were posted (so 'phanopen' can never land after 'phanclose'), a failed
+    # send is retried with exponential backoff before moving on to the next.
+    def __init__(self, url, auth, max_queue=64, max_retries=3, retry_backoff=0.5, timeout=5.0):
+        self.__url = url
+        self.__auth = auth
+        self.__max_retries = max_retries
+        self.__retry_backoff = retry_backoff
+        self.__timeout = aiohttp.ClientTimeout(total=timeout)
+        
+        self.__queue = asyncio.Queue(maxsize=max_queue)
+        self.__worker = None
+        self.__session = None
+        
+        self.latency_ms = Histogram([5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000])
+        self.queue_wait_ms = Histogram([1, 5, 10, 50, 100, 500, 1000, 5000])
+        self.max_queue_depth = 0
+        self.num_sent = 0
+        self.num_retries = 0
+        self.num_failed = 0
+        self.num_dropped = 0
+        
+    ###########################################################################
+    # Public facing methods
+    ###########################################################################
+    def post(self, channel, event_name, event_data=None):
+        # Never blocks, safe to call from the game callbacks on the event loop
+        self.__ensure_worker()
+        
+        try:
+            self.__queue.put_nowait((time.perf_counter(), channel, event_name, event_data))
+        except asyncio.QueueFull:
+            self.num_dropped += 1
+            print(f"Funtoon queue full, dropped event '{event_name}'")
+            return False
+            
+        self.max_queue_depth = max(self.max_queue_depth, self.__queue.qsize())
+        return True
+        
+    def queue_depth(self):
+        return self.__queue.qsize()
+        
+    async def flush(self):
+        await self.__queue.join()
+        
+    async def close(self):
+        if self.__worker:
+            self.__worker.cancel()
+            self.__worker = None
+        if self.__session:
+            await self.__session.close()
+            self.__session = None
+            
+    def summary(self):
+        return '\n'.join([
+            f'sent: {self.num_sent}, retries: {self.num_retries}, failed: {self.num_failed}, dropped: {self.num_dropped}',
+            f'queue depth: {self.queue_depth()} (max {self.max_queue_depth})',
+            f'queue wait (ms) p50 {self.queue_wait_ms.percentile(50)} p95 {self.queue_wait_ms.percentile(95)} p99 {self.queue_wait_ms.percentile(99)}',
+            f'latency (ms) p50 {self.latency_ms.percentile(50)} p95 {self.latency_ms.percentile(95)} p99 {self.latency_ms.percentile(99)}',
+        ])
+        
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __ensure_worker(self):
+        if not self.__worker or self.__worker.done():
+            self.__worker = asyncio.get_running_loop().create_task(self.__run())
+            
+    async def __run(self):
+        if not self.__session:
+            connector = aiohttp.TCPConnector(limit=4, keepalive_timeout=60)
+            self.__session = aiohttp.ClientSession(connector=connector, timeout=self.__timeout)
+            
+        while True:
+            queued_at, channel, event_name, event_data = await self.__queue.get()
+            self.queue_wait_ms.add((time.perf_counter() - queued_at) * 1000.0)
+            try:
+                await self.__send_with_retry(channel, event_name, event_data)
+            finally:
+                self.__queue.task_done()
+                
+    async def __send_with_retry(self, channel, event_name, event_data):
+        headers = {
+            'Authorization': self.__auth.get_funtoon_token(),
+            'Content-Type': 'Application/json'
+        }
+        content_data = {
+            'channel': channel,
+            'event': event_name,
+            'data': event_data
+        }
+        
+        for attempt in range(self.__max_retries + 1):
+            if attempt:
+                self.num_retries += 1
+                await asyncio.sleep(self.__retry_backoff * (2 ** (attempt - 1)))
+                
+            start = time.perf_counter()
+            try:
+                async with self.__session.post(self.__url, headers=headers, json=content_data) as r:
+                    await r.read()
+                    if r.status < 400:
+                        self.latency_ms.add((time.perf_counter() - start) * 1000.0)
+                        self.num_sent += 1
+                        return True
+                    # client errors (a bad funtoon_token too) won't get better by retrying
+                    if r.status < 500 and r.status != 429:
+                        self.num_failed += 1
+                        print(f"Funtoon rejected '{event_name}' with status {r.status}")
+                        return False
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+                
+        self.num_failed += 1
+        print(f"Failed to send '{event_name}' to Funtoon")
+        return False
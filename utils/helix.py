@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import asyncio
+import aiohttp
+
+class HelixClient():
+    # Looks up Twitch user IDs by login. IDs never change for an account, so
+    # they're cached on disk and a restart or resubscribe doesn't hit the API
+    # at all, anything missing is fetched 100 logins per request.
+    MaxLoginsPerRequest = 100
+    
+    def __init__(self, auth, cache_path='helix_users.json', cache_ttl=7 * 24 * 60 * 60):
+        self.__auth = auth
+        self.__cache_path = cache_path
+        self.__cache_ttl = cache_ttl
+        self.__session = None
+        
+        # login -> (id, fetched at as unix time), the id is None for a login
+        # Helix didn't return so it isn't asked for again until it expires
+        self.__user_ids = {}
+        self.__load_cache()
+        
+        self.num_requests = 0
+    
+    ###########################################################################
+    # Public facing methods
+    ###########################################################################
+    async def get_user_ids(self, logins):
+        # login -> id for every login that exists, in the order given
+        logins = [login.lower() for login in logins]
+        now = time.time()
+        missing = [login for login in dict.fromkeys(logins) if not self.__is_fresh(login, now)]
+        
+        if missing:
+            for i in range(0, len(missing), HelixClient.MaxLoginsPerRequest):
+                batch = missing[i:i + HelixClient.MaxLoginsPerRequest]
+                users = await self.__request_users(batch)
+                if users is None:
+                    continue
+                for login in batch:
+                    self.__user_ids[login] = (None, now)
+                for user in users:
+                    self.__user_ids[user['login'].lower()] = (user['id'], now)
+            await asyncio.get_running_loop().run_in_executor(None, self.__save_cache, dict(self.__user_ids))
+        
+        found = { login: self.__user_ids[login][0] for login in logins if login in self.__user_ids }
+        return { login: user_id for login, user_id in found.items() if user_id is not None }
+    
+    async def cancel_redemption(self, broadcaster_id, reward_id, redemption_id):
+        # Refunds the points. Twitch only allows this for rewards created by
+        # our client id, with a token that has channel:manage:redemptions.
+        params = [('broadcaster_id', broadcaster_id), ('reward_id', reward_id), ('id', redemption_id)]
+        j = await self.__request('PATCH', 'channel_points/custom_rewards/redemptions', params, { 'status': 'CANCELED' })
+        if 'data' not in j:
+            print(f"Unable to refund redemption '{redemption_id}': {j.get('message', j)}")
+            return False
+        return True
+        
+    async def close(self):
+        if self.__session:
+            await self.__session.close()
+            self.__session = None
+    
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __is_fresh(self, login, now):
+        return login in self.__user_ids and now - self.__user_ids[login][1] < self.__cache_ttl
+    
+    async def __request_users(self, logins):
+        j = await self.__request('GET', 'users', [('login', login) for login in logins])
+        if 'data' not in j:
+            print(f"Helix user lookup failed: {j.get('message', j)}")
+            # not cached as missing, the lookup itself failed
+            return None
+        return j['data']
+        
+    async def __request(self, method, endpoint, params, body=None):
+        if not self.__session or self.__session.closed:
+            self.__session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        
+        for attempt in range(2):
+            headers = {
+                'Client-ID': self.__auth.get_client_id(),
+                'Authorization': f'Bearer {await self.__auth.get_valid_access_token()}'
+            }
+            self.num_requests += 1
+            async with self.__session.request(method, f'https://api.twitch.tv/helix/{endpoint}', params=params, json=body, headers=headers) as r:
+                if r.status == 401 and attempt == 0:
+                    # token was revoked early, refresh it and try once more
+                    await self.__auth.refresh_access_token()
+                    continue
+                return await r.json(content_type=None)
+        return {}
+    
+    def __load_cache(self):
+        try:
+            with open(self.__cache_path, 'r') as f:
+                self.__user_ids = { login: tuple(entry) for login, entry in json.load(f).items() }
+        except (OSError, ValueError):
+            self.__user_ids = {}
+    
+    def __save_cache(self, user_ids):
+        temp_path = f'{self.__cache_path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(user_ids, f, indent=4)
+        os.replace(temp_path, self.__cache_path)
@@ -1,21 +1,70 @@
-import requests
 import os
+import re
 import shutil
-import random
-from io import BytesIO
+import asyncio
+import hashlib
+import aiohttp
+import collections
+from utils.piclibrary import PictureLibrary
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# leading bytes -> file extension for the formats OBS can show
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+]
+
+IMAGE_CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'gif': 'image/gif',
+    'bmp': 'image/bmp',
+    'webp': 'image/webp',
+}
+
+def sniff_image_type(data):
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    for signature, extension in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    return None
 
 class ImageHandler():
-    def __init__(self, pic_location, pictures_folder, start_index=-1):
+    # Images from chat are streamed to a temp file in the cache folder, checked
+    # to really be an image, then renamed into place so neither the event
+    # loop nor OBS ever sees a half written picture. Library pictures are
+    # hardlinked in the same way, in the order kept by PictureLibrary.
+    # With a PictureServer nothing is written for OBS at all, the current and
+    # next few pictures are kept in memory and pushed to the browser source.
+    def __init__(self, pic_location, pictures_folder, start_index=-1, cache_folder='stashio_pic_cache', max_download_bytes=8 * 1024 * 1024, download_timeout=10.0, max_resolution=None, max_cached_pics=200, index_path=None, picture_server=None, prefetch_count=3):
         self.__REGEX_URL_PARSE = r"""(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"""
         
-        random.seed()
-        
         self.__pic_location = pic_location
         self.__pictures_folder = pictures_folder
-        self.__pics = self.__get_images_in_directory(self.__pictures_folder)
-        self.__current_index = 0
+        self.__pics = PictureLibrary(pictures_folder, index_path or f'{pictures_folder.rstrip("/")}_index.json')
+        if start_index >= 0:
+            self.__pics.set_position(start_index)
         
-        random.shuffle(self.__pics)
+        self.__cache_folder = cache_folder
+        self.__max_download_bytes = max_download_bytes
+        self.__download_timeout = aiohttp.ClientTimeout(total=download_timeout)
+        # (width, height) of the OBS source, bigger downloads get shrunk to fit
+        self.__max_resolution = max_resolution
+        self.__max_cached_pics = max_cached_pics
+        self.__session = None
+        
+        self.__picture_server = picture_server
+        self.__prefetch_count = prefetch_count
+        # name -> (data, content type) for the current and upcoming pictures
+        self.__in_memory = collections.OrderedDict()
         
     ###########################################################################
     # Public facing methods
@@ -29,28 +78,187 @@ class ImageHandler():
             url = found_urls[0] if len(found_urls) > 0 else None
         return url
         
-    def change_pic_from_url(self, image_url):
-        response = requests.get(image_url)
-        img_data = BytesIO(response.content)
+    async def change_pic_from_url(self, image_url):
+        cached_path = self.__find_cached(image_url)
+        if not cached_path:
+            try:
+                cached_path = await self.__download(image_url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                print(f"Couldn't download image '{image_url}': {e}")
+                return False
+            if not cached_path:
+                return False
+                
+        loop = asyncio.get_running_loop()
+        if self.__picture_server:
+            self.__picture_server.set_picture(*await loop.run_in_executor(None, self.__read_pic, cached_path))
+        else:
+            await loop.run_in_executor(None, self.__link_file_to_location, cached_path, self.__pic_location)
+        return True
         
-        with open(self.__pic_location, "wb") as outfile:
-            outfile.write(img_data.getbuffer())
+    async def close(self):
+        self.__pics.close()
+        if self.__session:
+            await self.__session.close()
+            self.__session = None
             
     def get_current_pic(self):
-        return self.__pics[self.__current_index]
+        return self.__pics.current()
             
     def next_pic(self):
-        self.set_pic_from_index((self.__current_index + 1) % len(self.__pics))
+        if not self.__pics.advance():
+            print(f"No pictures in '{self.__pictures_folder}'")
+            return
+        self.__show_current_pic()
         
     def set_pic_from_index(self, index):
-        self.__current_index = index
-        self.__copy_file_to_location('%s/%s' % (self.__pictures_folder, self.get_current_pic()), self.__pic_location)
+        self.__pics.set_position(index)
+        self.__show_current_pic()
             
     ###########################################################################
     # Private helper methods
     ###########################################################################
-    def __get_images_in_directory(self, sub_path=''):
-        return os.listdir(sub_path)
+    def show_current_pic(self):
+        if self.get_current_pic():
+            self.__show_current_pic()
+            
+    def __show_current_pic(self):
+        if not self.__picture_server:
+            self.__link_file_to_location('%s/%s' % (self.__pictures_folder, self.get_current_pic()), self.__pic_location)
+            return
+            
+        name = self.get_current_pic()
+        picture = self.__in_memory.get(name) or self.__read_pic('%s/%s' % (self.__pictures_folder, name))
+        self.__picture_server.set_picture(*picture)
+        self.__prefetch()
+        
+    def __read_pic(self, location):
+        with open(location, 'rb') as f:
+            data = f.read()
+        return data, IMAGE_CONTENT_TYPES.get(sniff_image_type(data), 'application/octet-stream')
+        
+    def __prefetch(self):
+        # keep the next few pictures loaded so the next redemption never touches the disk
+        wanted = [self.__pics.peek(offset) for offset in range(self.__prefetch_count + 1)]
+        for name in list(self.__in_memory):
+            if name not in wanted:
+                del self.__in_memory[name]
+                
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        for name in wanted:
+            if name not in self.__in_memory:
+                future = loop.run_in_executor(None, self.__read_pic, '%s/%s' % (self.__pictures_folder, name))
+                future.add_done_callback(lambda f, name=name: self.__on_prefetched(name, f))
+                
+    def __on_prefetched(self, name, future):
+        if future.exception() is None:
+            self.__in_memory[name] = future.result()
+            
+        
+    def __link_file_to_location(self, old_location, new_location):
+        # hardlink (or copy, across drives) next to the destination then
+        # rename over it, OBS either sees the old picture or the new one
+        temp_location = f'{new_location}.tmp'
+        if os.path.lexists(temp_location):
+            os.remove(temp_location)
+        try:
+            os.link(old_location, temp_location)
+        except OSError:
+            shutil.copy(old_location, temp_location)
+        os.replace(temp_location, new_location)
+        
+    def __cache_key(self, image_url):
+        return hashlib.sha1(image_url.encode('utf-8')).hexdigest()
+        
+    def __find_cached(self, image_url):
+        if not os.path.isdir(self.__cache_folder):
+            return None
+        key = self.__cache_key(image_url)
+        for name in os.listdir(self.__cache_folder):
+            if name.startswith(key + '.') and not name.endswith('.part'):
+                path = os.path.join(self.__cache_folder, name)
+                os.utime(path)
+                return path
+        return None
+        
+    async def __download(self, image_url):
+        if not self.__session or self.__session.closed:
+            self.__session = aiohttp.ClientSession(timeout=self.__download_timeout)
+        os.makedirs(self.__cache_folder, exist_ok=True)
+        
+        key = self.__cache_key(image_url)
+        temp_path = os.path.join(self.__cache_folder, f'{key}.part')
+        extension = None
+        num_bytes = 0
+        
+        try:
+            async with self.__session.get(image_url) as response:
+                if response.status != 200:
+                    print(f"Couldn't download image '{image_url}': HTTP {response.status}")
+                    return None
+                    
+                content_type = response.headers.get('Content-Type', '')
+                if content_type and not content_type.startswith('image/'):
+                    print(f"Not downloading '{image_url}', it isn't an image ({content_type})")
+                    return None
+                if response.content_length and response.content_length > self.__max_download_bytes:
+                    print(f"Not downloading '{image_url}', it's too big ({response.content_length} bytes)")
+                    return None
+                    
+                with open(temp_path, 'wb') as outfile:
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        if extension is None:
+                            # the first chunk has to look like an image we know
+                            extension = sniff_image_type(chunk)
+                            if not extension:
+                                print(f"Not downloading '{image_url}', it doesn't look like an image")
+                                return None
+                                
+                        num_bytes += len(chunk)
+                        if num_bytes > self.__max_download_bytes:
+                            print(f"Stopped downloading '{image_url}', it's bigger than {self.__max_download_bytes} bytes")
+                            return None
+                        outfile.write(chunk)
+                        
+            if extension is None:
+                return None
+                
+            cached_path = os.path.join(self.__cache_folder, f'{key}.{extension}')
+            await asyncio.get_running_loop().run_in_executor(None, self.__finish_download, temp_path, cached_path, extension)
+            return cached_path
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+                
+    def __finish_download(self, temp_path, cached_path, extension):
+        # runs on a worker thread, resizing can take a moment on big pictures
+        if not self.__shrink_image(temp_path, cached_path, extension):
+            os.replace(temp_path, cached_path)
+        self.__evict_cache()
+        
+    def __shrink_image(self, old_location, new_location, extension):
+        # optional, needs Pillow. Animated gifs are left alone.
+        if not self.__max_resolution or not Image or extension == 'gif':
+            return False
+        with Image.open(old_location) as image:
+            if image.width <= self.__max_resolution[0] and image.height <= self.__max_resolution[1]:
+                return False
+            image_format = image.format
+            image.thumbnail(self.__max_resolution)
+            image.save(f'{new_location}.part', format=image_format)
+        os.replace(f'{new_location}.part', new_location)
+        return True
         
-    def __copy_file_to_location(self, old_location, new_location):
-        shutil.copy(old_location, new_location)
\ No newline at end of file
+    def __evict_cache(self):
+        entries = [e for e in os.scandir(self.__cache_folder) if e.is_file() and not e.name.endswith('.part')]
+        if len(entries) <= self.__max_cached_pics:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:len(entries) - self.__max_cached_pics]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
\ No newline at end of file
@@ -1,25 +1,48 @@
 import json
 
+# orjson is a lot faster at parsing when it's installed
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+class JsonPath():
+    # A path like 'data/redemption/user/login' split once up front, so
+    # looking it up is just walking the keys. Lists along the way are mapped
+    # over like JsonParse always did.
+    __slots__ = ('keys',)
+    
+    def __init__(self, path):
+        self.keys = tuple(path.split('/'))
+    
+    def get(self, data, default=None):
+        val = data
+        for key in self.keys:
+            if isinstance(val, list):
+                val = [v.get(key, default) if isinstance(v, dict) else None for v in val]
+            elif isinstance(val, dict):
+                val = val.get(key, default)
+            else:
+                return default
+            if val is None:
+                return default
+        return val
+
+_compiled_paths = {}
+
+def compile_path(path):
+    compiled = _compiled_paths.get(path)
+    if compiled is None:
+        compiled = _compiled_paths[path] = JsonPath(path)
+    return compiled
+
 # I took this from a blog post:
 # https://www.haykranen.nl/2016/02/13/handling-complex-nested-dicts-in-python/
 class JsonParse():
     def __init__(self, json_data):
         self.__data = json_data
-
+    
     def get(self, path, default = None):
-        keys = path.split("/")
-        val = None
-
-        for key in keys:
-            if val:
-                if isinstance(val, list):
-                    val = [ v.get(key, default) if v else None for v in val]
-                else:
-                    val = val.get(key, default)
-            else:
-                val = self.__data.get(key, default)
-
-            if not val:
-                break;
-
-        return val
\ No newline at end of file
+        # only a missing key gives the default, 0 and "" are real values
+        return compile_path(path).get(self.__data, default)
@@ -0,0 +1,115 @@
+import re
+import collections
+from utils.chatmessage import EMOTE_PLACEHOLDER_REGEX
+
+# Offline prefilter that decides whether a chat message is English before we
+# spend a remote language detection call on it. The "model" is a ranked list
+# of common English (and chat) words, a character trigram profile built from
+# that list, and the most common function words of the other languages we
+# see in chat, which count against English.
+
+ENGLISH_WORDS = '''
+the be to of and a in that have i it for not on with he as you do at this but his by from they we say her
+she or an will my one all would there their what so up out if about who get which go me when make can like
+time no just him know take people into year your good some could them see other than then now look only
+come its over think also back after use two how our work first well way even new want because any these
+give day most us is are was were been has had did does am im i'm dont don't cant can't wont won't didnt
+didn't isnt isn't thats that's it's youre you're theyre they're whats what's lets let's here why where
+very really much more still too lot need feel thing things got going gonna wanna yeah yes yep nope ok okay
+thanks thank please sorry hello hey hi bye sure maybe never always again right left off down should those
+being same every something nothing anything everything someone everyone great nice cool bad best better
+love fun game run play playing played watch stream chat man guys guy bro dude wait wow damn though
+today tonight tomorrow yesterday morning night last next big little old long fast slow hard easy
+pb wr gg lol lmao rofl omg wtf btw imo tbh idk np ty thx pog poggers lul kek ez rip brb afk gl hf glhf
+phantoon ceres moat samus boss room split splits reset resets seed route
+'''.split()
+
+# frequent letter trigrams of running English text, for words not in the list above
+ENGLISH_TRIGRAMS = '''
+the and ing ion tio ent for hat tha her ere ate his con res ver all ons nce men ith ted ers pro thi wit are
+ess not ive was ect rea com eve per int est sta cti ica ist ear ain one our iti rat nte tin ine der ome man
+pre rom tra whi ave str act ill igh ght oun lly sti eas ove tur ong ble ous ure ter ell red ort
+art ard ali ati ide ade ies ely ful les ity ake ame ang ank anc ack ich ick ink ind
+ire ise ite ize nes ore ose ost oth own qui rin rou sed ses sho shi som tch tor und ust ven way wer
+wha whe wor you yin ily ncr edi ibl sly hon ene usl ans
+'''.split()
+
+# the most frequent words of other languages that rarely show up in English text
+FOREIGN_WORDS = {
+    'fr': 'le la les un une des est et je tu il elle nous vous ils pas que qui dans pour sur avec ce cette mais ou très bien merci oui non salut bonjour c\'est suis'.split(),
+    'es': 'el la los las un una es y yo tu que de en por para con pero muy bien gracias hola si no como está esta qué soy eres'.split(),
+    'pt': 'o a os as um uma é e eu você que de em por para com mas muito bem obrigado olá sim não como está'.split(),
+    'de': 'der die das ein eine ist und ich du er sie wir ihr nicht mit aber sehr gut danke hallo ja nein wie auch was'.split(),
+    'it': 'il lo la gli le un una è e io tu che di in per con ma molto bene grazie ciao sì no come sono'.split(),
+    'nl': 'de het een is en ik jij je hij zij wij niet met maar heel goed dank hallo ja nee hoe ook wat'.split(),
+}
+
+class LanguageIdentifier():
+    def __init__(self, confidence_threshold=0.75, num_trigrams=400):
+        self.__confidence_threshold = confidence_threshold
+        self.__english_words = set(ENGLISH_WORDS)
+        self.__foreign_words = set(w for words in FOREIGN_WORDS.values() for w in words) - self.__english_words
+        self.__trigrams = self.__build_trigram_profile(num_trigrams)
+        
+        self.__word_regex = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?")
+        self.__placeholder_regex = EMOTE_PLACEHOLDER_REGEX
+        self.__url_regex = re.compile(r'\S+\.\S+/\S*|https?://\S+')
+        
+    ###########################################################################
+    # Public facing methods
+    ###########################################################################
+    def is_untranslatable(self, text):
+        # emote-only, command-like, links or nothing with letters in it
+        text = text.strip()
+        if not text or text[0] in '!/':
+            return True
+        text = self.__url_regex.sub(' ', self.__placeholder_regex.sub(' ', text))
+        return not self.__word_regex.search(text)
+        
+    def is_confidently_english(self, text):
+        return self.english_confidence(text) >= self.__confidence_threshold
+        
+    def english_confidence(self, text):
+        text = self.__url_regex.sub(' ', self.__placeholder_regex.sub(' ', text)).lower()
+        words = self.__word_regex.findall(text)
+        if not words:
+            return 0.0
+            
+        # anything outside Latin script is not English
+        if any(ord(c) > 0x24F for w in words for c in w):
+            return 0.0
+            
+        score = 0.0
+        foreign = 0
+        for word in words:
+            if word in self.__english_words:
+                score += 1.0
+            elif word in self.__foreign_words:
+                foreign += 1
+            else:
+                score += 0.8 * self.__trigram_score(word)
+                
+        confidence = score / len(words)
+        if foreign:
+            confidence *= (len(words) - foreign) / len(words)
+        # a single unknown word isn't much to go on
+        if len(words) == 1 and words[0] not in self.__english_words:
+            confidence = min(confidence, 0.5)
+        return confidence
+        
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __trigram_score(self, word):
+        padded = f' {word} '
+        trigrams = [padded[i:i + 3] for i in range(len(padded) - 2)]
+        return sum(t in self.__trigrams for t in trigrams) / len(trigrams)
+        
+    def __build_trigram_profile(self, num_trigrams):
+        # weight trigrams by word rank (Zipf), the word list is roughly in frequency order
+        counts = collections.Counter()
+        for rank, word in enumerate(ENGLISH_WORDS):
+            padded = f' {word} '
+            for i in range(len(padded) - 2):
+                counts[padded[i:i + 3]] += 1.0 / (rank + 1)
+        return set(t for t, _ in counts.most_common(num_trigrams)) | set(ENGLISH_TRIGRAMS)
@@ -1,50 +1,143 @@
+import asyncio
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from googletrans import Translator
+from utils.langid import LanguageIdentifier
 
 class MessageTranslator():
-    def __init__(self):
-        self.__translator = Translator()
+    def __init__(self, max_workers=2, cache_size=1024, batch_window=0.05, max_batch_size=16, timeout=3.0, max_users=4096):
+        # googletrans makes blocking network calls, keep them off the event loop
+        self.__executor = ThreadPoolExecutor(max_workers, 'translate')
+        self.__thread_local = threading.local()
         
-    def chat_auto_translate(self, message):
-        fixed_message, emotes = self.__strip_message_for_translate(message)
-        detected = None
-
-        try:
-            detected = self.__translator.detect(fixed_message)
-            if detected.lang != 'en' and detected.confidence > 0.90:
-                translated = self.__translator.translate(fixed_message)
-                fixed_message = self.__fix_stripped_message(translated.text, emotes)
-                return translated.src, translated.dest, fixed_message
-        except:
+        # emote-stripped text -> (language, (src, dest, translated text) or None when it wasn't translated)
+        self.__cache = collections.OrderedDict()
+        self.__cache_size = cache_size
+        
+        # English, emote-only and command-like messages never reach the remote detector
+        self.__language_id = LanguageIdentifier()
+        # user -> language of their last detected message
+        self.__user_languages = collections.OrderedDict()
+        self.__max_users = max_users
+        
+        # messages arriving within the batch window go out as one request
+        self.__batch_window = batch_window
+        self.__max_batch_size = max_batch_size
+        self.__timeout = timeout
+        self.__pending = dict()
+        self.__flush_handle = None
+        
+    async def chat_auto_translate(self, tokens, user=None):
+        # tokens is the TokenizedMessage from utils.chatmessage
+        if tokens.is_emote_only or tokens.is_command:
+            return None, None, None
+            
+        fixed_message = tokens.stripped_text()
+        if self.__language_id.is_untranslatable(fixed_message):
+            return None, None, None
+            
+        user_language = self.__user_languages.get(user)
+        # people we know don't chat in English go straight to translation
+        skip_detect = user_language is not None and user_language != 'en'
+        if not skip_detect and self.__language_id.is_confidently_english(fixed_message):
             return None, None, None
-
-        return None, None, None
         
-    def __strip_message_for_translate(self, message):
-        if not 'emotes' in message.tags or message.tags['emotes'] == '':
-            return message.content, []
+        try:
+            result = await asyncio.wait_for(asyncio.shield(self.__translate(fixed_message, skip_detect)), self.__timeout)
+        except asyncio.TimeoutError:
+            return None, None, None
+            
+        if result:
+            language, translation = result
+            self.__remember_language(user, language)
+            if translation:
+                src, dest, text = translation
+                return src, dest, tokens.restore_emotes(text)
             
-        emotes = message.tags['emotes'].split('/')
-        to_replace = []
-        for emote in emotes:
-            id, replacement = emote.split(':')
-            splices = replacement.split(',')
-            for splice in splices:
-                start, end = splice.split('-')
-                to_replace.append((int(start), int(end)+1, id))
+        return None, None, None
         
-        to_replace = sorted(to_replace, key=lambda x: x[0], reverse=True)
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __remember_language(self, user, language):
+        if user and language:
+            self.__user_languages[user] = language
+            self.__user_languages.move_to_end(user)
+            while len(self.__user_languages) > self.__max_users:
+                self.__user_languages.popitem(last=False)
+                
+    def __translate(self, text, skip_detect):
+        loop = asyncio.get_running_loop()
         
-        emote_text = {}
-        new_message = message.content
-        for start, end, id in to_replace:
-            if not id in emote_text:
-                emote_text[id] = new_message[start:end]
-            new_message = f'{new_message[:start]}__{id}__{new_message[end:]}'
+        future = loop.create_future()
+        if text in self.__cache:
+            self.__cache.move_to_end(text)
+            future.set_result(self.__cache[text])
+            return future
+            
+        # the same text already waiting in this batch shares its result
+        if text in self.__pending:
+            return self.__pending[text][0]
             
-        return new_message, emote_text
+        self.__pending[text] = (future, skip_detect)
+        if len(self.__pending) >= self.__max_batch_size:
+            self.__flush()
+        elif not self.__flush_handle:
+            self.__flush_handle = loop.call_later(self.__batch_window, self.__flush)
+        return future
         
-    def __fix_stripped_message(self, message, emotes):
-        for emote_id in emotes:
-            message = message.replace(f'__{emote_id}__', emotes[emote_id])
+    def __flush(self):
+        if self.__flush_handle:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+            
+        batch = self.__pending
+        self.__pending = dict()
+        if batch:
+            task = asyncio.get_running_loop().run_in_executor(self.__executor, self.__translate_batch_blocking, [(text, skip_detect) for text, (_, skip_detect) in batch.items()])
+            task.add_done_callback(lambda t: self.__on_batch_done(batch, t))
             
-        return message
\ No newline at end of file
+    def __on_batch_done(self, batch, task):
+        results = None if task.cancelled() or task.exception() else task.result()
+        for i, (text, (future, _)) in enumerate(batch.items()):
+            result = results[i] if results else None
+            if results:
+                self.__cache_result(text, result)
+            if not future.done():
+                future.set_result(result)
+                
+    def __cache_result(self, text, result):
+        self.__cache[text] = result
+        self.__cache.move_to_end(text)
+        while len(self.__cache) > self.__cache_size:
+            self.__cache.popitem(last=False)
+            
+    def __translate_batch_blocking(self, texts):
+        translator = self.__get_translator()
+        
+        results = [(None, None)] * len(texts)
+        to_translate = [i for i, (_, skip_detect) in enumerate(texts) if skip_detect]
+        
+        to_detect = [i for i, (_, skip_detect) in enumerate(texts) if not skip_detect]
+        if to_detect:
+            detections = translator.detect([texts[i][0] for i in to_detect])
+            for i, detected in zip(to_detect, detections):
+                results[i] = (detected.lang, None)
+                if detected.lang != 'en' and (detected.confidence or 0) > 0.90:
+                    to_translate.append(i)
+        
+        if to_translate:
+            translations = translator.translate([texts[i][0] for i in to_translate])
+            for i, translated in zip(to_translate, translations):
+                if translated.src != 'en':
+                    results[i] = (translated.src, (translated.src, translated.dest, translated.text))
+                else:
+                    results[i] = ('en', None)
+        return results
+        
+    def __get_translator(self):
+        # one Translator (and its http client) per worker thread
+        if not hasattr(self.__thread_local, 'translator'):
+            self.__thread_local.translator = Translator()
+        return self.__thread_local.translator
@@ -0,0 +1,221 @@
+import os
+import json
+import random
+import collections
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+class PictureLibrary():
+    # Shuffled play order of a pictures folder. The order and position are
+    # saved to an index file, and a restart only rescans the folder if it
+    # changed since (its mtime moves whenever a file is added, removed or
+    # renamed). While running, changes come in through watchdog when it's
+    # installed, otherwise the folder mtime is checked on each access.
+    def __init__(self, pictures_folder, index_path):
+        self.__pictures_folder = pictures_folder
+        self.__index_path = index_path
+        self.__position_path = f'{index_path}.pos'
+        
+        self.__order = []
+        self.__positions = {}
+        self.__position = 0
+        self.__folder_mtime = None
+        
+        # (event type, name, new name) from the watchdog thread
+        self.__pending = collections.deque()
+        self.__observer = None
+        
+        if not self.__load_index():
+            self.refresh()
+        self.__start_watching()
+    
+    ###########################################################################
+    # Public facing methods
+    ###########################################################################
+    def __len__(self):
+        self.__apply_changes()
+        return len(self.__order)
+    
+    def __contains__(self, name):
+        self.__apply_changes()
+        return name in self.__positions
+    
+    def current(self):
+        self.__apply_changes()
+        if not self.__order:
+            return None
+        return self.__order[self.__position]
+    
+    def peek(self, offset):
+        # the picture offset places after the current one
+        self.__apply_changes()
+        if not self.__order:
+            return None
+        return self.__order[(self.__position + offset) % len(self.__order)]
+    
+    def position(self):
+        return self.__position
+    
+    def advance(self):
+        self.__apply_changes()
+        if not self.__order:
+            return None
+        self.set_position((self.__position + 1) % len(self.__order))
+        return self.current()
+    
+    def set_position(self, position):
+        self.__apply_changes()
+        if not self.__order:
+            return
+        self.__position = position % len(self.__order)
+        self.__save_position()
+    
+    def refresh(self):
+        # full scan, keeps the existing order and shuffles new pictures into
+        # the part of the cycle that hasn't been shown yet
+        self.__folder_mtime = self.__get_folder_mtime()
+        names = self.__scan()
+        
+        current = self.__order[self.__position] if self.__order else None
+        found = set(names)
+        order = [name for name in self.__order if name in found]
+        known = set(order)
+        new_names = [name for name in names if name not in known]
+        random.shuffle(new_names)
+        
+        if not order:
+            order = new_names
+            position = 0
+        else:
+            position = order.index(current) if current in known else min(self.__position, len(order) - 1)
+            for name in new_names:
+                order.insert(random.randint(position + 1, len(order)), name)
+        
+        self.__set_order(order, position)
+        self.__save_index()
+    
+    def close(self):
+        if self.__observer:
+            self.__observer.stop()
+            self.__observer.join()
+            self.__observer = None
+    
+    def dispatch(self, event):
+        # called by watchdog on its own thread, just queue it up for the next access
+        if event.is_directory:
+            return
+        name = os.path.basename(event.src_path)
+        if event.event_type == 'created':
+            self.__pending.append(('created', None, name))
+        elif event.event_type == 'deleted':
+            self.__pending.append(('deleted', name, None))
+        elif event.event_type == 'moved':
+            dest_path = event.dest_path
+            new_name = os.path.basename(dest_path) if os.path.dirname(os.path.abspath(dest_path)) == os.path.abspath(self.__pictures_folder) else None
+            self.__pending.append(('moved', name, new_name))
+    
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __scan(self):
+        with os.scandir(self.__pictures_folder) as entries:
+            return [entry.name for entry in entries if self.__is_picture_name(entry.name) and entry.is_file()]
+    
+    def __is_picture_name(self, name):
+        # skip hidden files and our own half written temp files
+        return not name.startswith('.') and not name.endswith(('.tmp', '.part'))
+    
+    def __get_folder_mtime(self):
+        return os.stat(self.__pictures_folder).st_mtime_ns
+    
+    def __set_order(self, order, position):
+        self.__order = order
+        self.__positions = { name: i for i, name in enumerate(order) }
+        self.__position = position if order else 0
+    
+    def __add(self, name):
+        if name in self.__positions or not self.__is_picture_name(name):
+            return
+        index = random.randint(min(self.__position + 1, len(self.__order)), len(self.__order))
+        self.__order.insert(index, name)
+        self.__reindex_from(index)
+    
+    def __remove(self, name):
+        index = self.__positions.pop(name, None)
+        if index is None:
+            return
+        del self.__order[index]
+        if index < self.__position:
+            self.__position -= 1
+        self.__position = min(self.__position, max(0, len(self.__order) - 1))
+        self.__reindex_from(index)
+    
+    def __reindex_from(self, index):
+        for i in range(index, len(self.__order)):
+            self.__positions[self.__order[i]] = i
+    
+    def __apply_changes(self):
+        if self.__observer:
+            if not self.__pending:
+                return
+            while self.__pending:
+                event_type, name, new_name = self.__pending.popleft()
+                if event_type in ('created', 'moved') and new_name:
+                    if event_type == 'moved':
+                        self.__remove(name)
+                    if os.path.isfile(os.path.join(self.__pictures_folder, new_name)):
+                        self.__add(new_name)
+                elif event_type in ('deleted', 'moved'):
+                    self.__remove(name)
+            self.__folder_mtime = self.__get_folder_mtime()
+            self.__save_index()
+        elif self.__get_folder_mtime() != self.__folder_mtime:
+            self.refresh()
+    
+    def __start_watching(self):
+        if not Observer:
+            return
+        self.__observer = Observer()
+        self.__observer.schedule(self, self.__pictures_folder, recursive=False)
+        self.__observer.daemon = True
+        self.__observer.start()
+    
+    def __load_index(self):
+        try:
+            with open(self.__index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+        
+        position = 0
+        try:
+            with open(self.__position_path, 'r') as f:
+                position = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            pass
+        
+        order = index.get('order', [])
+        self.__set_order(order, min(max(0, position), max(0, len(order) - 1)))
+        self.__folder_mtime = index.get('folder_mtime')
+        
+        # the index is only trusted as is if nothing changed in the folder since
+        if self.__folder_mtime != self.__get_folder_mtime():
+            self.refresh()
+        return True
+    
+    def __save_index(self):
+        self.__write_file(self.__index_path, json.dumps({ 'folder_mtime': self.__folder_mtime, 'order': self.__order }))
+        self.__save_position()
+    
+    def __save_position(self):
+        # tiny separate file so advancing doesn't rewrite the whole order
+        self.__write_file(self.__position_path, str(self.__position))
+    
+    def __write_file(self, path, content):
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, path)
@@ -0,0 +1,111 @@
+import asyncio
+from aiohttp import web, WSMsgType
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<style>
+html, body { margin: 0; height: 100%; background: transparent; overflow: hidden; }
+img { width: 100%; height: 100%; object-fit: contain; }
+</style>
+</head>
+<body>
+<img id="pic" src="/pic">
+<script>
+const pic = document.getElementById('pic');
+function connect() {
+    const ws = new WebSocket(`ws://${location.host}/ws`);
+    ws.onmessage = (event) => {
+        // load it off screen first so the old picture stays up until the new one is ready
+        const next = new Image();
+        next.onload = () => { pic.src = next.src; };
+        next.src = `/pic?v=${event.data}`;
+    };
+    ws.onclose = () => setTimeout(connect, 1000);
+}
+connect();
+</script>
+</body>
+</html>
+"""
+
+class PictureServer():
+    # Serves the current channel picture from memory to an OBS browser source
+    # pointed at http://host:port/. The page keeps a websocket open and is told
+    # the moment the picture changes, instead of OBS polling a file on disk.
+    def __init__(self, host='127.0.0.1', port=8765):
+        self.__host = host
+        self.__port = port
+        self.__data = None
+        self.__content_type = None
+        self.__version = 0
+        self.__sockets = set()
+        self.__runner = None
+    
+    ###########################################################################
+    # Public facing methods
+    ###########################################################################
+    async def start(self):
+        if self.__runner:
+            return
+        app = web.Application()
+        app.router.add_get('/', self.__handle_page)
+        app.router.add_get('/pic', self.__handle_pic)
+        app.router.add_get('/ws', self.__handle_ws)
+        
+        self.__runner = web.AppRunner(app)
+        await self.__runner.setup()
+        await web.TCPSite(self.__runner, self.__host, self.__port).start()
+        print(f'Serving the channel picture on http://{self.__host}:{self.__port}/')
+    
+    async def stop(self):
+        for ws in list(self.__sockets):
+            await ws.close()
+        if self.__runner:
+            await self.__runner.cleanup()
+            self.__runner = None
+    
+    def set_picture(self, data, content_type):
+        self.__data = data
+        self.__content_type = content_type
+        self.__version += 1
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no loop yet, pages pick the picture up when they connect
+            return
+        for ws in list(self.__sockets):
+            loop.create_task(self.__notify(ws, self.__version))
+    
+    def num_viewers(self):
+        return len(self.__sockets)
+    
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __handle_page(self, request):
+        return web.Response(text=PAGE, content_type='text/html')
+    
+    async def __handle_pic(self, request):
+        if self.__data is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.__data, content_type=self.__content_type, headers={ 'Cache-Control': 'no-cache' })
+    
+    async def __handle_ws(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        self.__sockets.add(ws)
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self.__sockets.discard(ws)
+        return ws
+    
+    async def __notify(self, ws, version):
+        try:
+            await ws.send_str(str(version))
+        except (ConnectionError, RuntimeError):
+            self.__sockets.discard(ws)
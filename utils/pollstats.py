@@ -0,0 +1,112 @@
+import bisect
+import collections
+
+class Histogram():
+    def __init__(self, bounds):
+        # bounds are the inclusive upper edges of each bucket, anything above the
+        # last one lands in an overflow bucket
+        self.__bounds = sorted(bounds)
+        self.__counts = [0] * (len(self.__bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+        
+    def add(self, value):
+        self.__counts[bisect.bisect_left(self.__bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+        
+    def mean(self):
+        return self.total / self.count if self.count else 0
+        
+    def percentile(self, p):
+        # upper edge of the bucket the p-th percentile falls into
+        if not self.count:
+            return 0
+        target = p / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.__counts):
+            seen += count
+            if seen >= target and count:
+                return self.__bounds[i] if i < len(self.__bounds) else self.max
+        return self.max
+        
+    def buckets(self):
+        labels = [f'<={b}' for b in self.__bounds] + [f'>{self.__bounds[-1]}']
+        return list(zip(labels, self.__counts))
+        
+    def __str__(self):
+        return ' '.join(f'{label}:{count}' for label, count in self.buckets() if count)
+
+class PollStats():
+    FrameCounterWrap = 0x10000
+    
+    # How many frames may pass between two reads of this field before a
+    # change could be hiding an intermediate value the edge detectors never saw
+    MissedEventThresholds = {
+        'room_id'   : 30,
+        'game_state': 10,
+        'samus_hp'  : 10,
+        'enemy_hp'  : 10,
+    }
+    
+    def __init__(self, max_suspect_events=100):
+        self.sample_spacing = Histogram([1, 2, 3, 4, 6, 8, 10, 15, 20, 30, 60, 120])
+        self.read_latency_ms = Histogram([1, 2, 4, 8, 16, 33, 50, 100, 250, 500, 1000])
+        self.ticks = 0
+        self.frames_skipped = 0
+        self.last_frames_skipped = 0
+        self.suspect_events = collections.deque(maxlen=max_suspect_events)
+        
+        # frame counter of the last tick that read it
+        self.__last_frame = None
+        # field -> (frame counter, value) of the last tick that actually read it,
+        # fields polled at a slower rate carry stale values in between
+        self.__last_read = dict()
+        
+    def record(self, new_info, read_latency, read_fields=None):
+        # read_fields are the fields read this tick, None if all of new_info was
+        self.ticks += 1
+        self.read_latency_ms.add(read_latency * 1000.0)
+        
+        if read_fields is None:
+            read_fields = new_info.keys()
+        frame = new_info.get('frame_counter')
+        if frame is None or 'frame_counter' not in read_fields:
+            return
+            
+        if self.__last_frame is not None:
+            spacing = (frame - self.__last_frame) % PollStats.FrameCounterWrap
+            self.sample_spacing.add(spacing)
+            self.last_frames_skipped = max(spacing - 1, 0)
+            self.frames_skipped += self.last_frames_skipped
+        self.__last_frame = frame
+        
+        for field in read_fields:
+            value = new_info.get(field)
+            if value is None:
+                continue
+            last = self.__last_read.get(field)
+            self.__last_read[field] = (frame, value)
+            
+            threshold = PollStats.MissedEventThresholds.get(field)
+            if threshold is None or last is None:
+                continue
+            last_frame, last_value = last
+            gap = (frame - last_frame) % PollStats.FrameCounterWrap
+            if gap > threshold and last_value != value:
+                self.suspect_events.append((field, last_value, value, gap))
+                
+    def summary(self):
+        lines = [
+            f'ticks: {self.ticks}, frames skipped: {self.frames_skipped} (last tick: {self.last_frames_skipped})',
+            f'sample spacing (frames) mean {self.sample_spacing.mean():.2f} p50 {self.sample_spacing.percentile(50)} p95 {self.sample_spacing.percentile(95)} p99 {self.sample_spacing.percentile(99)}',
+            f'  {self.sample_spacing}',
+            f'read latency (ms) mean {self.read_latency_ms.mean():.2f} p50 {self.read_latency_ms.percentile(50)} p95 {self.read_latency_ms.percentile(95)} p99 {self.read_latency_ms.percentile(99)}',
+            f'  {self.read_latency_ms}',
+            f'possibly missed transitions: {len(self.suspect_events)}',
+        ]
+        for field, before, after, spacing in self.suspect_events:
+            lines.append(f'  {field}: {before} -> {after} across {spacing} frames')
+        return '\n'.join(lines)
@@ -4,6 +4,9 @@ import json
 import struct
 import math
 import sys
+import time
+import collections
+import itertools
 
 class BaseAddressConverter():
     def __init__(self, rom_base, wram_base, sram_base):
@@ -41,16 +44,188 @@ class SnesDevice():
         converted = [(self.__addr_converter.get_wram_addr(addr), size) for addr, size in addr_and_sizes]
         return await self.__qusb2snes.read_wram_batch(converted)
         
+    def compile_wram_plan(self, addr_and_sizes):
+        return WramReadPlan([(self.__addr_converter.get_wram_addr(addr), size) for addr, size in addr_and_sizes])
+        
+    async def read_wram_plan(self, plan):
+        return await self.__qusb2snes.read_wram_plan(plan)
+        
     def name(self):
         return self.__device_name
 
+class WramReadPlan():
+    def __init__(self, addr_and_sizes):
+        self.addr_and_sizes = addr_and_sizes
+        # requests: [(operands, num_bytes)], fields: [(buffer offset, size)]
+        self.requests = []
+        self.fields = []
+        self.generation = -1
+        self.num_bytes = 0
+        self.__decoders = []
+        
+    def update(self, requests, fields, generation):
+        self.requests = requests
+        self.fields = fields
+        self.generation = generation
+        self.num_bytes = sum(num_bytes for _, num_bytes in requests)
+        self.__decoders = [WramReadPlan.__make_decoder(offset, size) for offset, size in fields]
+        
+    def decode(self, data):
+        return [decode(data) for decode in self.__decoders]
+        
+    def __make_decoder(offset, size):
+        is_power_of_2 = (size & (size - 1) == 0) and (size != 0)
+        
+        if is_power_of_2 and size <= 8:
+            unpack_from = struct.Struct('<' + 'cHIQ'[int(math.log2(size))]).unpack_from
+            return lambda data: unpack_from(data, offset)[0]
+            
+        return lambda data: data[offset:offset + size]
+
+class WramReadPlanner():
+    # Merges nearby/overlapping reads into spans and packs the spans into as
+    # few GetAddress requests as possible. Results are sliced back out locally.
+    def plan(self, addr_and_sizes, max_request_size, max_gap, generation=0):
+        return self.compile(WramReadPlan(addr_and_sizes), max_request_size, max_gap, generation)
+        
+    def compile(self, plan, max_request_size, max_gap, generation=0):
+        addr_and_sizes = plan.addr_and_sizes
+        intervals = sorted(set((addr, addr + size) for addr, size in addr_and_sizes))
+        
+        spans = []
+        for start, end in intervals:
+            if spans:
+                span_start, span_end = spans[-1]
+                merged_end = max(span_end, end)
+                if start <= span_end + max_gap and merged_end - span_start <= max_request_size:
+                    spans[-1] = (span_start, merged_end)
+                    continue
+            spans.append((start, end))
+            
+        requests = []
+        span_offsets = []
+        operands = []
+        num_bytes = 0
+        buffer_offset = 0
+        for start, end in spans:
+            size = end - start
+            if operands and num_bytes + size > max_request_size:
+                requests.append((operands, num_bytes))
+                operands = []
+                num_bytes = 0
+            operands += [hex(start)[2:], hex(size)[2:]]
+            num_bytes += size
+            span_offsets.append((start, end, buffer_offset))
+            buffer_offset += size
+        if operands:
+            requests.append((operands, num_bytes))
+            
+        fields = []
+        for addr, size in addr_and_sizes:
+            for start, end, offset in span_offsets:
+                if start <= addr and addr + size <= end:
+                    fields.append((offset + addr - start, size))
+                    break
+                    
+        plan.update(requests, fields, generation)
+        return plan
+
+class RequestSizeTuner():
+    # Picks the max request size and the merge gap for a device from measured
+    # round trip times. The gap is how many unused bytes are cheaper to read
+    # than paying for another span, the request size grows while the fixed
+    # per-request overhead dominates and shrinks again when reads fail.
+    HARDWARE_PREFIXES = ('SD2SNES', 'FXPAK')
+    
+    # shared so plans compiled for one tuner are never mistaken as fresh for another
+    __generations = itertools.count()
+    
+    def __init__(self, device_name):
+        is_hardware = (device_name or '').upper().startswith(RequestSizeTuner.HARDWARE_PREFIXES)
+        
+        self.__floor = 64
+        self.__ceiling = 512 if is_hardware else 2048
+        self.__samples = collections.deque(maxlen=32)
+        self.__num_new_samples = 0
+        
+        self.max_request_size = 64 if is_hardware else 256
+        self.max_gap = 8
+        self.generation = next(RequestSizeTuner.__generations)
+        
+    def record(self, num_bytes, rtt):
+        self.__samples.append((num_bytes, rtt))
+        self.__num_new_samples += 1
+        if self.__num_new_samples >= self.__samples.maxlen:
+            self.__num_new_samples = 0
+            self.__retune()
+            
+    def record_failure(self):
+        self.__samples.clear()
+        self.__num_new_samples = 0
+        self.__set(max(self.__floor, self.max_request_size // 2), self.max_gap)
+        
+    def __retune(self):
+        overhead, per_byte = self.__estimate_cost()
+        
+        max_request_size = self.max_request_size
+        max_gap = self.max_gap
+        if per_byte > 0:
+            max_gap = int(min(64, overhead / per_byte))
+            if per_byte * max_request_size < overhead:
+                max_request_size = min(self.__ceiling, max_request_size * 2)
+        elif overhead > 0:
+            max_request_size = min(self.__ceiling, max_request_size * 2)
+            
+        self.__set(max_request_size, max_gap)
+        
+    def __estimate_cost(self):
+        # least squares fit of rtt = overhead + per_byte * num_bytes
+        n = len(self.__samples)
+        mean_x = sum(x for x, _ in self.__samples) / n
+        mean_y = sum(y for _, y in self.__samples) / n
+        var_x = sum((x - mean_x) ** 2 for x, _ in self.__samples)
+        if var_x == 0:
+            return mean_y, 0
+            
+        per_byte = sum((x - mean_x) * (y - mean_y) for x, y in self.__samples) / var_x
+        per_byte = max(per_byte, 0)
+        return max(mean_y - per_byte * mean_x, 0), per_byte
+        
+    def __set(self, max_request_size, max_gap):
+        if (max_request_size, max_gap) != (self.max_request_size, self.max_gap):
+            self.max_request_size = max_request_size
+            self.max_gap = max_gap
+            self.generation = next(RequestSizeTuner.__generations)
+
+class PendingRequest():
+    def __init__(self, expected_size):
+        # expected_size is None for requests answered with a JSON reply
+        self.expected_size = expected_size
+        self.future = asyncio.get_running_loop().create_future()
+        self.data = b''
+        
+    def resolve(self, result):
+        if not self.future.done():
+            self.future.set_result(result)
+            
+    def fail(self, exception):
+        if not self.future.done():
+            self.future.set_exception(exception)
+
 class QUsb2Snes():
     def __init__(self, hostname, port):
         self.__reconnecting = False
         self.__attached_device_name = None
         self.__url = f"ws://{hostname}:{port}"
-        self.__lock = asyncio.Lock()
+        self.__send_lock = asyncio.Lock()
         self.__ws = None
+        self.__reader_task = None
+        # responses come back in request order, so they're matched to this FIFO
+        self.__pending = collections.deque()
+        self.__read_timeout = 1.0
+        self.__info_timeout = 5.0
+        self.__planner = WramReadPlanner()
+        self.__tuner = RequestSizeTuner(None)
         
     def __command(self, opcode, operands=None):
         data = {
@@ -73,9 +248,7 @@ class QUsb2Snes():
         
     async def reconnect(self):
         if not self.__reconnecting and self.__attached_device_name:
-            if self.__ws:
-                await self.__ws.close()
-                self.__ws = None
+            await self.__close()
             print(f"Lost connection to {self.__attached_device_name}. Reconnecting...")
             self.__reconnecting = True
             
@@ -83,11 +256,10 @@ class QUsb2Snes():
         return self.__reconnecting
         
     async def connect(self):
-        if self.__ws:
-            await self.__ws.close()
-            self.__ws = None
-            
+        await self.__close()
+        
         self.__ws = await websockets.connect(self.__url)
+        self.__reader_task = asyncio.get_running_loop().create_task(self.__read_responses(self.__ws))
         
     async def send(self, data):
         try:
@@ -97,35 +269,41 @@ class QUsb2Snes():
             await self.reconnect()
             return False
             
-    async def read(self):
+    async def request(self, data, expected_size=None, timeout=None):
+        pending = PendingRequest(expected_size)
+        async with self.__send_lock:
+            if not self.__ws:
+                return None
+            self.__pending.append(pending)
+            await self.send(data)
+            
         try:
-            d = await asyncio.wait_for(self.__ws.recv(), timeout=5.0)
-            return d
-        except:
+            return await asyncio.wait_for(pending.future, timeout or self.__read_timeout)
+        except asyncio.TimeoutError:
+            # a response that never arrives would shift every later one onto the wrong request
             await self.reconnect()
-            return None
+        except ConnectionError:
+            pass
+        return None
         
     async def get_devices(self):
-        async with self.__lock:
-            data = ""
-            await self.send(self.__command("DeviceList"))
-            data = await self.read()
-            try:
-                return json.loads(data)
-            except:
-                print("Failed to parse devices:")
-                print(data)
-                return {'Results': []}
+        data = await self.request(self.__command("DeviceList"), timeout=self.__info_timeout)
+        try:
+            return json.loads(data)
+        except:
+            print("Failed to parse devices:")
+            print(data)
+            return {'Results': []}
     
     async def attach_to_device(self, device):
         try:
-            async with self.__lock:
-                # try to attach
-                await self.send(self.__command("Attach", [device]))
-                # since it sends no response on success, we have to verify
-                await self.send(self.__command("Info", [device]))
-                response = json.loads(await self.read())['Results']
+            # try to attach
+            await self.send(self.__command("Attach", [device]))
+            # since it sends no response on success, we have to verify
+            response = json.loads(await self.request(self.__command("Info", [device]), timeout=self.__info_timeout))['Results']
                 
+            if device != self.__attached_device_name:
+                self.__tuner = RequestSizeTuner(device)
             self.__attached_device_name = device
             
             return SnesDevice(self, device)
@@ -144,26 +322,8 @@ class QUsb2Snes():
         
         return data
         
-    def __unpack_batch(self, data, sizes):
-        do_unpack_read = True
-        unpack_pattern = '<'
-        for size in sizes:
-            is_power_of_2 = (size & (size - 1) == 0) and (size != 0)
-            
-            if is_power_of_2 and size <= 8:
-                char = 'cHIQ'[int(math.log2(size))]
-                unpack_pattern = unpack_pattern + 'cHIQ'[int(math.log2(size))]
-            else:
-                do_unpack_read = False
-        if do_unpack_read:
-            return list(struct.unpack(unpack_pattern, data))
-            
-        return data
-    
     async def read_wram(self, addr, size):
-        async with self.__lock:
-            await self.send(self.__command("GetAddress", [hex(addr)[2:], hex(size)[2:]]))
-            r = await self.read()
+        r = await self.read_wram_raw(addr, size)
             
         if r:
             return self.__unpack(r, size)[0]
@@ -171,38 +331,88 @@ class QUsb2Snes():
         return None
         
     async def read_wram_raw(self, addr, size):
-        async with self.__lock:
-            await self.send(self.__command("GetAddress", [hex(addr)[2:], hex(size)[2:]]))
-            return await self.read()
+        return await self.request(self.__command("GetAddress", [hex(addr)[2:], hex(size)[2:]]), size)
             
     async def read_wram_batch(self, addr_and_sizes):
-        results = []
-        if not self.is_disconnected():
-            async with self.__lock:
-                to_send = []
-                num_req_bytes = 0
-                for addr, size in addr_and_sizes:
-                    if num_req_bytes + size <= 64:
-                        num_req_bytes += size
-                        to_send.append((addr, size))
-                        continue
-                    addr_size_list = [hex(item)[2:] for pair in to_send for item in pair]
-                    await self.send(self.__command("GetAddress", addr_size_list))
-                    r = await self.read()
-                    
-                    if r:
-                        results = results + self.__unpack_batch(r, list(zip(*to_send))[1])
-                    
-                    num_req_bytes = size
-                    to_send = [(addr, size)]
-                    
-                if num_req_bytes:
-                    addr_size_list = [hex(item)[2:] for pair in to_send for item in pair]
-                    await self.send(self.__command("GetAddress", addr_size_list))
-                    r = b''
-                    while len(r) < num_req_bytes:
-                        r += await self.read()
-                    if r:
-                        results = results + self.__unpack_batch(r, list(zip(*to_send))[1])
+        plan = self.__planner.plan(addr_and_sizes, self.__tuner.max_request_size, self.__tuner.max_gap, self.__tuner.generation)
+        return await self.read_wram_plan(plan)
+        
+    async def read_wram_plan(self, plan):
+        if self.is_disconnected():
+            return []
+            
+        # plans are cached by callers, recompile if the tuner moved on since
+        if plan.generation != self.__tuner.generation:
+            self.__planner.compile(plan, self.__tuner.max_request_size, self.__tuner.max_gap, self.__tuner.generation)
+            
+        # every request of the plan is in flight at once
+        results = await asyncio.gather(*[self.__timed_read(operands, num_bytes) for operands, num_bytes in plan.requests])
+        if any(r is None for r in results):
+            self.__tuner.record_failure()
+            return []
+                
+        return plan.decode(b''.join(results))
+        
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    async def __timed_read(self, operands, num_bytes):
+        start = time.perf_counter()
+        r = await self.request(self.__command("GetAddress", operands), num_bytes)
+        if r is not None:
+            self.__tuner.record(num_bytes, time.perf_counter() - start)
+        return r
+        
+    async def __read_responses(self, ws):
+        try:
+            async for message in ws:
+                if not self.__on_response(message):
+                    # can't tell which request it belongs to anymore, start over
+                    print("Unexpected reply from QUsb2Snes, reconnecting...")
+                    break
+        except asyncio.CancelledError:
+            raise
+        except:
+            pass
+            
+        # the socket went away underneath us, or its replies can't be trusted
+        if self.__ws is ws:
+            self.__fail_pending()
+            await self.reconnect()
+            
+    def __on_response(self, message):
+        # False if the reply isn't the kind the request at the front expects
+        while message and self.__pending:
+            pending = self.__pending[0]
+            if (pending.expected_size is None) != isinstance(message, str):
+                return False
                 
-        return results
\ No newline at end of file
+            if pending.expected_size is None:
+                self.__pending.popleft()
+                pending.resolve(message)
+                return True
+                
+            # binary replies can be fragmented or coalesced, split them by expected length
+            needed = pending.expected_size - len(pending.data)
+            pending.data += message[:needed]
+            message = message[needed:]
+            if len(pending.data) >= pending.expected_size:
+                self.__pending.popleft()
+                pending.resolve(pending.data)
+        return True
+        
+    def __fail_pending(self):
+        while self.__pending:
+            self.__pending.popleft().fail(ConnectionError("Connection to QUsb2Snes lost"))
+            
+    async def __close(self):
+        ws = self.__ws
+        self.__ws = None
+        
+        if self.__reader_task and self.__reader_task is not asyncio.current_task():
+            self.__reader_task.cancel()
+        self.__reader_task = None
+        
+        if ws:
+            await ws.close()
+        self.__fail_pending()
\ No newline at end of file
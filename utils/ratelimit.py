@@ -0,0 +1,17 @@
+import time
+import asyncio
+
+class RateLimiter():
+    # Spaces calls out evenly so no more than `rate` of them happen in any
+    # `per` second window, instead of bursting and then waiting. Each caller
+    # reserves the next free slot, so concurrent callers queue up in order.
+    def __init__(self, rate, per):
+        self.__interval = per / rate
+        self.__next_slot = 0.0
+        
+    async def acquire(self):
+        now = time.monotonic()
+        wait = self.__next_slot - now
+        self.__next_slot = max(now, self.__next_slot) + self.__interval
+        if wait > 0:
+            await asyncio.sleep(wait)
@@ -0,0 +1,106 @@
+import time
+import asyncio
+import inspect
+import collections
+from utils.pollstats import Histogram
+
+class RecentIds():
+    # The last max_size ids seen, for spotting repeats in O(1). Once full the
+    # oldest id is forgotten as each new one comes in.
+    def __init__(self, max_size=1024):
+        self.__order = collections.deque()
+        self.__ids = set()
+        self.__max_size = max_size
+        
+    def add(self, item_id):
+        # False if it was already seen
+        if item_id in self.__ids:
+            return False
+        if len(self.__order) >= self.__max_size:
+            self.__ids.discard(self.__order.popleft())
+        self.__order.append(item_id)
+        self.__ids.add(item_id)
+        return True
+        
+    def __len__(self):
+        return len(self.__order)
+
+class RewardExecutor():
+    # Runs one channel reward's callback off its own queue with up to
+    # `concurrency` redemptions in flight, so a slow reward can only ever
+    # hold up redemptions of the same reward. Callbacks can be plain
+    # functions or coroutines.
+    def __init__(self, name, callback, concurrency=1, max_queue=32):
+        self.name = name
+        self.__callback = callback
+        self.__concurrency = concurrency
+        self.__queue = asyncio.Queue(maxsize=max_queue)
+        self.__workers = []
+        
+        self.queue_wait_ms = Histogram([1, 5, 10, 50, 100, 500, 1000, 5000])
+        self.run_time_ms = Histogram([1, 5, 10, 50, 100, 500, 1000, 5000])
+        self.max_queue_depth = 0
+        self.num_run = 0
+        self.num_failed = 0
+        self.num_dropped = 0
+        
+    ###########################################################################
+    # Public facing methods
+    ###########################################################################
+    def submit(self, *args):
+        # Never blocks, False if the queue is full and the redemption was dropped
+        self.__ensure_workers()
+        
+        try:
+            self.__queue.put_nowait((time.perf_counter(), args))
+        except asyncio.QueueFull:
+            self.num_dropped += 1
+            print(f"'{self.name}' queue is full, dropped a redemption")
+            return False
+            
+        self.max_queue_depth = max(self.max_queue_depth, self.__queue.qsize())
+        return True
+        
+    def queue_depth(self):
+        return self.__queue.qsize()
+        
+    async def flush(self):
+        await self.__queue.join()
+        
+    async def close(self):
+        for worker in self.__workers:
+            worker.cancel()
+        self.__workers = []
+        
+    def summary(self):
+        return '\n'.join([
+            f'{self.name}: run: {self.num_run}, failed: {self.num_failed}, dropped: {self.num_dropped}, queue depth: {self.queue_depth()} (max {self.max_queue_depth})',
+            f'  queue wait (ms) p50 {self.queue_wait_ms.percentile(50)} p95 {self.queue_wait_ms.percentile(95)} p99 {self.queue_wait_ms.percentile(99)}',
+            f'  run time (ms) p50 {self.run_time_ms.percentile(50)} p95 {self.run_time_ms.percentile(95)} p99 {self.run_time_ms.percentile(99)}',
+        ])
+        
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __ensure_workers(self):
+        self.__workers = [worker for worker in self.__workers if not worker.done()]
+        loop = asyncio.get_running_loop()
+        while len(self.__workers) < self.__concurrency:
+            self.__workers.append(loop.create_task(self.__run()))
+            
+    async def __run(self):
+        while True:
+            queued_at, args = await self.__queue.get()
+            start = time.perf_counter()
+            self.queue_wait_ms.add((start - queued_at) * 1000.0)
+            try:
+                result = self.__callback(*args)
+                if inspect.isawaitable(result):
+                    await result
+                self.num_run += 1
+            except Exception as e:
+                self.num_failed += 1
+                print(f"'{self.name}' failed: {e}")
+            finally:
+                self.run_time_ms.add((time.perf_counter() - start) * 1000.0)
+                self.__queue.task_done()
@@ -0,0 +1,91 @@
+import mmap
+import struct
+import time
+
+# Compact binary log of SuperMetroid memory snapshots.
+#
+# Layout: a header (magic, field count, length-prefixed utf-8 field names)
+# followed by fixed-width little-endian records:
+#   float64 timestamp | uint32 presence bitmask | uint32 value per field
+# A field whose bit is clear wasn't read in that snapshot (e.g. a room field
+# outside its room) and is left out of the replayed snapshot, like live.
+
+SNAPSHOT_MAGIC = b'SMSNAP1\0'
+MAX_FIELDS = 32
+
+class SnapshotRecorder():
+    def __init__(self, path, field_names, flush_every=60):
+        assert len(field_names) <= MAX_FIELDS, f'At most {MAX_FIELDS} fields can be recorded'
+        
+        self.__field_names = list(field_names)
+        self.__record = struct.Struct('<dI' + 'I' * len(self.__field_names))
+        self.__flush_every = flush_every
+        self.__unflushed = 0
+        self.num_records = 0
+        
+        self.__file = open(path, 'wb')
+        self.__file.write(SNAPSHOT_MAGIC)
+        self.__file.write(struct.pack('<H', len(self.__field_names)))
+        for name in self.__field_names:
+            encoded = name.encode('utf-8')
+            self.__file.write(struct.pack('<B', len(encoded)) + encoded)
+            
+    def write(self, snapshot, timestamp=None):
+        present = 0
+        values = []
+        for i, name in enumerate(self.__field_names):
+            value = snapshot.get(name)
+            if isinstance(value, int):
+                present |= 1 << i
+                values.append(value & 0xFFFFFFFF)
+            else:
+                values.append(0)
+                
+        self.__file.write(self.__record.pack(time.time() if timestamp is None else timestamp, present, *values))
+        self.num_records += 1
+        
+        self.__unflushed += 1
+        if self.__unflushed >= self.__flush_every:
+            self.__unflushed = 0
+            self.__file.flush()
+            
+    def close(self):
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+class SnapshotReader():
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.__mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            
+        if self.__mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"'{path}' is not a snapshot log")
+            
+        offset = len(SNAPSHOT_MAGIC)
+        num_fields, = struct.unpack_from('<H', self.__mm, offset)
+        offset += 2
+        
+        self.field_names = []
+        for _ in range(num_fields):
+            length = self.__mm[offset]
+            self.field_names.append(self.__mm[offset + 1:offset + 1 + length].decode('utf-8'))
+            offset += 1 + length
+            
+        self.__record = struct.Struct('<dI' + 'I' * num_fields)
+        self.__data_offset = offset
+        # ignore a torn record at the end of a log that was still being written
+        self.num_records = (len(self.__mm) - offset) // self.__record.size
+        
+    def __len__(self):
+        return self.num_records
+        
+    def __iter__(self):
+        names = list(enumerate(self.field_names))
+        unpack_from = self.__record.unpack_from
+        for offset in range(self.__data_offset, self.__data_offset + self.num_records * self.__record.size, self.__record.size):
+            timestamp, present, *values = unpack_from(self.__mm, offset)
+            yield timestamp, { name: values[i] for i, name in names if present & (1 << i) }
+            
+    def close(self):
+        self.__mm.close()
@@ -2,6 +2,9 @@ import time
 import collections
 import asyncio
 from utils.qusb2snes import QUsb2Snes
+from utils.pollstats import PollStats
+from utils.snapshotlog import SnapshotRecorder, SnapshotReader
+from utils.eventbus import EventBus, Overflow
 
 # Info taken from several places
 # 1. https://jathys.zophar.net/supermetroid/kejardon/
@@ -93,6 +96,40 @@ class CeresEscapeState():
     EscapeTimerInitiated = 0x0002
     ElevatorRoomRotating = 0x8000
 
+class PollRates():
+    EveryFrame = 1.0 / 60.0
+    Default    = 10.0 / 60.0
+    Idle       = 1.0
+
+class PollScheduler():
+    # Every watched field has its own poll interval, each tick reads whatever is due.
+    # Fields coming due within `slack` of each other are read in the same tick.
+    def __init__(self, slack=PollRates.EveryFrame / 2):
+        self.__slack = slack
+        self.__next_due = dict()
+        
+    def due(self, fields, now):
+        return [f for f in fields if self.__next_due.get(f, 0) <= now + self.__slack]
+        
+    def polled(self, fields, now, get_rate):
+        for f in fields:
+            self.__next_due[f] = now + get_rate(f)
+            
+    def poll_now(self, field):
+        self.__next_due.pop(field, None)
+        
+    def time_until_next(self, fields, now):
+        if not fields:
+            return PollRates.Idle
+        return max(0, min(self.__next_due.get(f, 0) for f in fields) - now)
+
+class MemoryReadPlan():
+    def __init__(self, names, addr_and_sizes, wram_plan, subscriptions):
+        self.names = names
+        self.addr_and_sizes = addr_and_sizes
+        self.wram_plan = wram_plan
+        self.subscriptions = subscriptions
+
 class SuperMetroid():
     class Callbacks():
         RunStarted  = 0
@@ -106,25 +143,48 @@ class SuperMetroid():
     class MemoryUpdates():
         Ceres = 0
         
-    def __init__(self):        
+    # Wildcard for either side of a room transition
+    AnyRoom = -1
+    
+    # Event types for the bus next to the Callbacks ones
+    def memory_update_event(in_type):
+        return ('memory_update', in_type)
+        
+    def room_transition_event(before, after):
+        return ('room_transition', before, after)
+        
+    def field_change_event(fields):
+        return ('field_change', tuple(sorted(fields)))
+    
+    def __init__(self, hostname='localhost', port=8080):
         self.__update_game_thread = None
         
-        self.__update_rate = 1.0
+        self.__poll_scheduler = PollScheduler()
+        self.__poll_rate_overrides = dict()
+        self.__poll_wakeup = asyncio.Event()
+        self.__poll_stats = PollStats()
+        self.__recorder = None
         
-        self.__callbacks = dict()
-        self.__room_transition_callbacks = []
+        # every callback runs off the event bus, the poll loop only publishes
+        self.__events = EventBus()
+        self.__memory_update_subscribers = dict()
         self.__current_subscriptions = []
+        self.__read_plans = dict()
+        self.__active_fields = dict()
+        self.__subscription_key = frozenset()
         
         self.__prev_game_info = None
 
-        self.__qusb2snes = QUsb2Snes('localhost', 8080)
+        self.__qusb2snes = QUsb2Snes(hostname, port)
         self.__qusb2snes_device = None
 
         self.__wram_offsets = {
             'always_update': {
-                'room_id'   : { 'offset': 0x079B, 'size': 2 },
-                'game_state': { 'offset': 0x0998, 'size': 2 },
+                'room_id'   : { 'offset': 0x079B, 'size': 2, 'essential': True },
+                'game_state': { 'offset': 0x0998, 'size': 2, 'essential': True },
                 'samus_hp'  : { 'offset': 0x09C2, 'size': 2 },
+                # read with every snapshot so we know how many frames went by between samples
+                'frame_counter': { 'offset': 0x05B6, 'size': 2, 'essential': True, 'every_read': True },
             },
             # Memory address to read if you're in a specific room
             'room_update': {
@@ -143,16 +203,23 @@ class SuperMetroid():
         }
         
         self.__callback_info = {
-            # Subscription ID                         # Check if callback should be called      # Parameters for the callback
-            SuperMetroid.Callbacks.RunStarted:  { 'check': self.__is_new_run_started,       'params': lambda info: [], },
-            SuperMetroid.Callbacks.RunReset:    { 'check': self.__is_run_reset,             'params': lambda info: [], },
-            SuperMetroid.Callbacks.EnemyHP:     { 'check': self.__check_enemy_hp_change,    'params': lambda info: [info['enemy_hp']], },
-            SuperMetroid.Callbacks.SamusHP:     { 'check': self.__check_samus_hp_change,    'params': lambda info: [info['samus_hp']], },
-            SuperMetroid.Callbacks.PhantoonEye: { 'check': self.__check_phantoon_eye_timer, 'params': lambda info: [info['phantoon_eye_timer']], },
-            SuperMetroid.Callbacks.CeresTimer:  { 'check': self.__check_ceres_timer,        'params': lambda info: [info['ceres_timer'], info['game_state'] == GameStates.CeresDestroyedCinematic], },
-            SuperMetroid.Callbacks.GameState:   { 'check': self.__check_game_state,         'params': lambda info: [info['game_state']], },
+            # Subscription ID                         # Fields it depends on          # Check if callback should be called (None: any change)  # Parameters for the callback
+            SuperMetroid.Callbacks.RunStarted:  { 'fields': ['game_state'],                'check': self.__is_new_run_started,  'params': lambda info: [], },
+            SuperMetroid.Callbacks.RunReset:    { 'fields': ['room_id'],                   'check': self.__is_run_reset,        'params': lambda info: [], },
+            SuperMetroid.Callbacks.EnemyHP:     { 'fields': ['enemy_hp'],                  'check': None,                       'params': lambda info: [info['enemy_hp']], },
+            SuperMetroid.Callbacks.SamusHP:     { 'fields': ['samus_hp'],                  'check': None,                       'params': lambda info: [info['samus_hp']], },
+            SuperMetroid.Callbacks.PhantoonEye: { 'fields': ['phantoon_eye_timer'],        'check': None,                       'params': lambda info: [info['phantoon_eye_timer']], },
+            SuperMetroid.Callbacks.CeresTimer:  { 'fields': ['ceres_timer', 'game_state'], 'check': self.__check_ceres_timer,   'params': lambda info: [info['ceres_timer'], info['game_state'] == GameStates.CeresDestroyedCinematic], },
+            SuperMetroid.Callbacks.GameState:   { 'fields': ['game_state'],                'check': None,                       'params': lambda info: [info['game_state']], },
         }
         
+        # field -> event types to evaluate when it changes, and the order they
+        # were registered in so they're always published in the same order
+        self.__field_events = dict()
+        self.__event_order = dict()
+        for event_type, ci in self.__callback_info.items():
+            self.__add_field_dependency(event_type, ci['fields'])
+        
     async def reconnect_thread(self):
         while True:
             if self.__qusb2snes.is_disconnected():
@@ -184,16 +251,23 @@ class SuperMetroid():
             d = await self.choose_device(devices)
             if d:
                 self.__qusb2snes_device = await self.__qusb2snes.attach_to_device(d)
+                self.__invalidate_read_plans()
             else:
                 await asyncio.sleep(1)
         
         print(f'Attached to device {self.__qusb2snes_device.name()}')
             
-        self.__update_rate = 10.0 / 60.0
         while True:
             if self.__qusb2snes_device:
                 await self.__tick_update_game_info()
-                await asyncio.sleep(self.__update_rate)
+                
+                names = [name for name, _, _ in self.__get_active_fields()[0]]
+                self.__poll_wakeup.clear()
+                try:
+                    # a rate change (e.g. a burst) cuts the wait short
+                    await asyncio.wait_for(self.__poll_wakeup.wait(), self.__poll_scheduler.time_until_next(names, time.monotonic()))
+                except asyncio.TimeoutError:
+                    pass
             else:
                 await asyncio.sleep(1)
                 
@@ -201,82 +275,171 @@ class SuperMetroid():
         loop.create_task(self.main_tick())
         loop.create_task(self.reconnect_thread())
         
-    def subscribe(self, in_type, in_callback):
-        if not in_type in self.__callbacks:
-            self.__callbacks[in_type] = in_callback
+    def set_poll_rate(self, field, rate):
+        self.__poll_rate_overrides[field] = rate
+        self.__poll_scheduler.poll_now(field)
+        self.__poll_wakeup.set()
+        
+    def clear_poll_rate(self, field):
+        self.__poll_rate_overrides.pop(field, None)
+        
+    def get_poll_stats(self):
+        return self.__poll_stats
         
-    def unsubscribe(self, in_type):
-        if in_type in self.__callbacks:
-            del self.__callbacks[in_type]
+    def start_recording(self, path):
+        self.stop_recording()
+        self.__recorder = SnapshotRecorder(path, self.__get_all_field_names())
+        
+    def stop_recording(self):
+        if self.__recorder:
+            self.__recorder.close()
+            self.__recorder = None
+            
+    async def replay(self, path):
+        # Feed a recorded log through the same callback chain as the live poller, as fast as possible
+        reader = SnapshotReader(path)
+        self.__prev_game_info = None
+        num_snapshots = 0
+        try:
+            for timestamp, snapshot in reader:
+                subscriptions = [sub for sub in dict.fromkeys(sub for sub, _ in self.__current_subscriptions)
+                    if any(snapshot.get(name) is not None for name in self.__wram_offsets['subscriptions'].get(sub, {}))]
+                # the log doesn't say which fields were read that tick, treat them all as read
+                self.__poll_stats.record(snapshot, 0)
+                await self.__process_game_info(snapshot, subscriptions)
+                # let subscribers catch up like they do between live polls
+                await self.__events.drain()
+                num_snapshots += 1
+        finally:
+            reader.close()
+        return num_snapshots
+        
+    def get_event_stats(self):
+        return self.__events.summary()
+        
+    def subscribe(self, in_type, in_callback, max_queue=256, overflow=Overflow.DropOldest):
+        # any number of subscribers per type, each gets its own queue
+        return self.subscribe_many({ in_type: in_callback }, max_queue, overflow)
+        
+    def subscribe_many(self, handlers, max_queue=256, overflow=Overflow.DropOldest, name=None):
+        # One subscriber for several event types (Callbacks, memory_update_event
+        # and room_transition_event), its handlers see the events in the order
+        # they happened across all of those types
+        return self.__events.subscribe(handlers, max_queue, overflow, name)
+        
+    def unsubscribe(self, in_subscriber):
+        self.__events.unsubscribe(in_subscriber)
             
-    def subscribe_to_memory_update(self, in_type, in_callback):
+    def subscribe_to_memory_update(self, in_type, in_callback=None):
+        # Without a callback this only starts reading the fields, for a
+        # subscriber that already handles memory_update_event(in_type)
         if not (in_type, in_callback) in self.__current_subscriptions:
             self.__current_subscriptions.append((in_type, in_callback))
+            if in_callback:
+                self.__memory_update_subscribers[(in_type, in_callback)] = self.subscribe(SuperMetroid.memory_update_event(in_type), in_callback)
+            self.__invalidate_read_plans()
             
-    def unsubscribe_to_memory_update(self, in_type, in_callback):
+    def unsubscribe_to_memory_update(self, in_type, in_callback=None):
         if (in_type, in_callback) in self.__current_subscriptions:
             self.__current_subscriptions.remove((in_type, in_callback))
+            if in_callback:
+                self.unsubscribe(self.__memory_update_subscribers.pop((in_type, in_callback)))
+            self.__invalidate_read_plans()
         
+    def subscribe_to_field_changes(self, fields, in_callback):
+        # in_callback gets { field: (old, new) } for whichever of the fields
+        # changed, only on ticks where at least one of them did
+        event_type = SuperMetroid.field_change_event(fields)
+        self.__add_field_dependency(event_type, event_type[1])
+        return self.subscribe(event_type, in_callback)
+    
     def subscribe_to_room_transition(self, before, after, in_callback):
-        data = {
-            'from': before,
-            'to': after,
-            'callback': in_callback
-        }
-        self.__room_transition_callbacks.append(data)
+        # Either room can be SuperMetroid.AnyRoom, those callbacks are given
+        # the rooms (before, after) since they can't know them otherwise
+        return self.subscribe(SuperMetroid.room_transition_event(before, after), in_callback)
         
     async def __tick_update_game_info(self):
-        new_info = await self.__read_updated_memory()
+        start = time.perf_counter()
+        new_info, subscriptions, read_fields = await self.__read_updated_memory()
+        self.__poll_stats.record(new_info, time.perf_counter() - start, read_fields)
+        
+        if self.__recorder:
+            self.__recorder.write(new_info)
+            
+        await self.__process_game_info(new_info, subscriptions)
         
+    async def __process_game_info(self, new_info, subscriptions):
+        for sub in subscriptions:
+            self.__events.publish(SuperMetroid.memory_update_event(sub), new_info)
+            
         if self.__prev_game_info:
-            for subscription in self.__callbacks:
-                if self.__callbacks[subscription]:
-                    ci = self.__callback_info[subscription]
-                    if ci['check'](new_info):
-                        await self.__callbacks[subscription](*ci['params'](new_info))
-        
-            for transition in self.__room_transition_callbacks:
-                if self.__check_room_transition(new_info, transition['from'], transition['to']):
-                    await transition['callback']()
+            # one diff per tick, then only what depends on a changed field is looked at
+            changed = self.__diff_game_info(new_info)
+            for event_type in self.__get_affected_events(changed):
+                ci = self.__callback_info.get(event_type)
+                if ci is None:
+                    self.__events.publish(event_type, { field: changed[field] for field in event_type[1] if field in changed })
+                elif ci['check'] is None or ci['check'](new_info, changed):
+                    self.__events.publish(event_type, *ci['params'](new_info))
+        
+            if 'room_id' in changed:
+                self.__publish_room_transition(*changed['room_id'])
 
         # set this as our prev info now for next frame
         self.__prev_game_info = new_info
             
-    def __is_new_run_started(self, new_info):
-        return self.__check_game_transition(new_info, GameStates.GameOptionsMenu, GameStates.NewGamePostIntro)
+    def __diff_game_info(self, new_info):
+        # field -> (old, new) for every field that's new or has a new value
+        prev = self.__prev_game_info
+        return { field: (prev.get(field), value) for field, value in new_info.items() if field not in prev or prev[field] != value }
         
-    def __is_run_reset(self, new_info):
-        if 'room_id' in self.__prev_game_info and self.__prev_game_info['room_id'] != Rooms.Empty:
-            if 'room_id' in new_info and new_info['room_id'] == Rooms.Empty:
-                return GameStates.is_demo_state(self.__prev_game_info['game_state']) == False
+    def __add_field_dependency(self, event_type, fields):
+        if event_type in self.__event_order:
+            return
+        self.__event_order[event_type] = len(self.__event_order)
+        for field in fields:
+            self.__field_events.setdefault(field, []).append(event_type)
+    
+    def __get_affected_events(self, changed):
+        affected = set()
+        for field in changed:
+            for event_type in self.__field_events.get(field, ()):
+                if self.__events.has_subscribers(event_type):
+                    affected.add(event_type)
+        if len(affected) > 1:
+            return sorted(affected, key=self.__event_order.__getitem__)
+        return affected
+    
+    def __is_new_run_started(self, new_info, changed):
+        return self.__is_transition(changed, 'game_state', GameStates.GameOptionsMenu, GameStates.NewGamePostIntro)
+    
+    def __is_run_reset(self, new_info, changed):
+        before, after = changed['room_id']
+        if 'room_id' in self.__prev_game_info and before != Rooms.Empty and after == Rooms.Empty:
+            return GameStates.is_demo_state(self.__prev_game_info['game_state']) == False
                     
         return False
         
-    def __check_property_change(self, prop, new_info):
-        return prop in new_info and ((prop not in self.__prev_game_info) or self.__prev_game_info[prop] != new_info[prop])
-        
-    def __check_enemy_hp_change(self, new_info):
-        return self.__check_property_change('enemy_hp', new_info)
-        
-    def __check_samus_hp_change(self, new_info):
-        return self.__check_property_change('samus_hp', new_info)
-        
-    def __check_game_state(self, new_info):
-        return self.__check_property_change('game_state', new_info)
+    def __check_ceres_timer(self, new_info, changed):
+        is_ceres_cinematic = self.__is_transition(changed, 'game_state', GameStates.BlackoutFromCeres, GameStates.CeresDestroyedCinematic)
+        return 'ceres_timer' in changed or is_ceres_cinematic
         
-    def __check_phantoon_eye_timer(self, new_info):
-        return self.__check_property_change('phantoon_eye_timer', new_info)
-        
-    def __check_ceres_timer(self, new_info):
-        is_ceres_cinematic = self.__check_game_transition(new_info, GameStates.BlackoutFromCeres, GameStates.CeresDestroyedCinematic)
-        return self.__check_property_change('ceres_timer', new_info) or is_ceres_cinematic
-    
-    def __check_room_transition(self, new_info, before, after):
-        return self.__prev_game_info['room_id'] == before and new_info['room_id'] == after
-        
-    def __check_game_transition(self, new_info, before, after):
-        keys_valid = 'game_state' in self.__prev_game_info and 'game_state' in new_info
-        return keys_valid and self.__prev_game_info['game_state'] == before and new_info['game_state'] == after
+    def __publish_room_transition(self, before, after):
+        # the bus already has its subscribers keyed by event type, so the
+        # transition is just looked up, and only on ticks where the room changed
+        if before is None or after is None:
+            return
+            
+        event_type = SuperMetroid.room_transition_event(before, after)
+        if self.__events.has_subscribers(event_type):
+            self.__events.publish(event_type)
+        for wildcard in ((SuperMetroid.AnyRoom, after), (before, SuperMetroid.AnyRoom), (SuperMetroid.AnyRoom, SuperMetroid.AnyRoom)):
+            event_type = SuperMetroid.room_transition_event(*wildcard)
+            if self.__events.has_subscribers(event_type):
+                self.__events.publish(event_type, before, after)
+                
+    def __is_transition(self, changed, field, before, after):
+        return changed.get(field) == (before, after)
     
     async def __read_mem(self, addr, size):
         return await self.__qusb2snes_device.read_wram(addr, size)
@@ -284,45 +447,109 @@ class SuperMetroid():
     async def __read_mem_batch(self, addr_and_sizes):
         return await self.__qusb2snes_device.read_wram_batch(addr_and_sizes)
         
-    async def __read_updated_memory(self):
-        mem = dict()
-        all_reads = []
-        names = []
+    async def __read_mem_plan(self, plan):
+        return await self.__qusb2snes_device.read_wram_plan(plan.wram_plan)
+        
+    def __get_poll_rate(self, field, info):
+        if info and info['game_state'] is not None:
+            if info['game_state'] == GameStates.Paused or GameStates.is_demo_state(info['game_state']):
+                return PollRates.Idle
+            # title screen and menus, only watch for a run starting
+            if info['room_id'] == Rooms.Empty and not self.__is_essential_field(field):
+                return PollRates.Idle
+                
+        return self.__poll_rate_overrides.get(field, PollRates.Default)
+        
+    def __is_essential_field(self, field):
+        return self.__wram_offsets['always_update'].get(field, {}).get('essential', False)
+        
+    def __get_all_field_names(self):
+        names = list(self.__wram_offsets['always_update'])
+        for fields in list(self.__wram_offsets['room_update'].values()) + list(self.__wram_offsets['subscriptions'].values()):
+            names += [name for name in fields if name not in names]
+        return names
+        
+    def __is_every_read_field(self, field):
+        return self.__wram_offsets['always_update'].get(field, {}).get('every_read', False)
         
-        for field in self.__wram_offsets['always_update']:
-            assert field not in mem, f"'{field}' already present in __wram_offsets"
-            info = self.__wram_offsets['always_update'][field]
-            names.append(field)
-            all_reads.append((info['offset'], info['size']))
+    def __get_room_key(self):
+        room_id = self.__prev_game_info['room_id'] if self.__prev_game_info else None
+        return (room_id, self.__subscription_key)
+        
+    def __get_active_fields(self):
+        key = self.__get_room_key()
+        active = self.__active_fields.get(key)
+        if active is None:
+            active = self.__collect_active_fields(key[0])
+            self.__active_fields[key] = active
+        return active
+        
+    def __get_read_plan(self, due_fields):
+        key = (self.__get_room_key(), frozenset(due_fields))
+        
+        plan = self.__read_plans.get(key)
+        if plan is None:
+            plan = self.__compile_read_plan(due_fields)
+            self.__read_plans[key] = plan
+        return plan
+        
+    def __invalidate_read_plans(self):
+        self.__subscription_key = frozenset(sub for sub, _ in self.__current_subscriptions)
+        self.__active_fields.clear()
+        self.__read_plans.clear()
+        
+    def __collect_active_fields(self, room_id):
+        fields = []
+        
+        def add_fields(offsets):
+            for field in offsets:
+                assert field not in [f for f, _, _ in fields], f"'{field}' already present in __wram_offsets"
+                fields.append((field, offsets[field]['offset'], offsets[field]['size']))
+        
+        add_fields(self.__wram_offsets['always_update'])
         
         # Check if there's any addresses we want to read if we're in this specific room
-        if self.__prev_game_info and self.__prev_game_info['room_id'] in self.__wram_offsets['room_update']:
-            room_info = self.__wram_offsets['room_update'][self.__prev_game_info['room_id']]
-            for field in room_info:
-                assert field not in mem, f"'{field}' already present in __wram_offsets"
-                info = room_info[field]
-                names.append(field)
-                all_reads.append((info['offset'], info['size']))
+        if room_id in self.__wram_offsets['room_update']:
+            add_fields(self.__wram_offsets['room_update'][room_id])
+            
+        subscriptions = []
+        for sub, _ in self.__current_subscriptions:
+            if sub in self.__wram_offsets['subscriptions'] and not sub in subscriptions:
+                add_fields(self.__wram_offsets['subscriptions'][sub])
+                subscriptions.append(sub)
                 
-        for sub, sub_callback in self.__current_subscriptions:
-            if sub in self.__wram_offsets['subscriptions']:
-                sub_info = self.__wram_offsets['subscriptions'][sub]
-                cb_mem = {}
-                for mem_name in sub_info:
-                    names.append(mem_name)
-                    all_reads.append((sub_info[mem_name]['offset'], sub_info[mem_name]['size']))
+        return fields, subscriptions
+        
+    def __compile_read_plan(self, due_fields):
+        fields, subscriptions = self.__get_active_fields()
+        
+        fields = [f for f in fields if f[0] in due_fields]
+        names = [name for name, _, _ in fields]
+        all_reads = [(offset, size) for _, offset, size in fields]
+        
+        # only hand subscribers the snapshot when some of their fields were read
+        subscriptions = [sub for sub in subscriptions if any(name in self.__wram_offsets['subscriptions'][sub] for name in names)]
                 
-        results = await self.__read_mem_batch(all_reads)
-        if len(results) == len(names):
-            for i in range(len(names)):
-                mem[names[i]] = results[i]
-        
-            # now do callbacks
-            for sub, sub_callback in self.__current_subscriptions:
-                if sub in self.__wram_offsets['subscriptions']:
-                    await sub_callback(mem)
-        else:
-            for n in names:
-                mem[n] = None
-        return mem
-        
\ No newline at end of file
+        wram_plan = self.__qusb2snes_device.compile_wram_plan(all_reads) if self.__qusb2snes_device else None
+        return MemoryReadPlan(names, all_reads, wram_plan, subscriptions)
+        
+    async def __read_updated_memory(self):
+        now = time.monotonic()
+        active_names = [name for name, _, _ in self.__get_active_fields()[0]]
+        due_fields = self.__poll_scheduler.due(active_names, now)
+        if due_fields:
+            due_fields += [name for name in active_names if self.__is_every_read_field(name) and name not in due_fields]
+        plan = self.__get_read_plan(due_fields)
+        
+        results = await self.__read_mem_plan(plan)
+        if len(results) == len(plan.names):
+            # fields that weren't due this tick keep their last value
+            mem = { name: self.__prev_game_info.get(name) for name in active_names } if self.__prev_game_info else dict.fromkeys(active_names)
+            mem.update(zip(plan.names, results))
+            self.__poll_scheduler.polled(plan.names, now, lambda field: self.__get_poll_rate(field, mem))
+            return mem, plan.subscriptions, plan.names
+            
+        # nothing was read (e.g. disconnected), wait an idle period before
+        # trying again instead of finding every field still due right away
+        self.__poll_scheduler.polled(active_names, now, lambda field: PollRates.Idle)
+        return dict.fromkeys(active_names), [], []
\ No newline at end of file
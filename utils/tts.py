@@ -1,41 +1,419 @@
 import pyttsx3
 import random
+import time
+import os
+import sys
+import queue
+import wave
+import heapq
+import asyncio
+import hashlib
+import itertools
+import threading
+import subprocess
+import collections
+import multiprocessing
+
+# pyttsx3's default speaking rate
+WORDS_PER_MINUTE = 200
+
+class FakeVoice():
+    def __init__(self, voice_id, name):
+        self.id = voice_id
+        self.name = name
+
+class FakeTTSEngine():
+    # Stands in for a pyttsx3 engine so TTS can run headless. Rendering writes
+    # a silent wav as long as the message would take to say.
+    def __init__(self, words_per_minute=WORDS_PER_MINUTE):
+        self.__properties = {
+            'voices': [FakeVoice(f'fake-{i}', name) for i, name in enumerate(TTS.VoiceNames)],
+            'volume': 1.0,
+            'voice': None,
+            'rate': words_per_minute,
+        }
+        self.__queued = []
+        
+    def getProperty(self, name):
+        return self.__properties[name]
+        
+    def setProperty(self, name, value):
+        self.__properties[name] = value
+        
+    def say(self, msg):
+        self.__queued.append((msg, None))
+        
+    def save_to_file(self, msg, path):
+        self.__queued.append((msg, path))
+        
+    def runAndWait(self):
+        for msg, path in self.__queued:
+            seconds = estimate_speech_seconds(msg, self.__properties['rate'])
+            if path:
+                write_silent_wav(path, seconds)
+            else:
+                time.sleep(seconds)
+        self.__queued = []
+
+def estimate_speech_seconds(msg, words_per_minute=None):
+    return 0.5 + len(msg.split()) * 60.0 / (words_per_minute or WORDS_PER_MINUTE)
+
+def write_silent_wav(path, seconds, sample_rate=8000):
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(1)
+        w.setframerate(sample_rate)
+        w.writeframes(b'\x80' * int(seconds * sample_rate))
+
+def wav_seconds(path):
+    with wave.open(path, 'rb') as w:
+        return w.getnframes() / float(w.getframerate())
+
+def play_wav_blocking(path):
+    if sys.platform == 'win32':
+        import winsound
+        winsound.PlaySound(path, winsound.SND_FILENAME)
+    elif sys.platform == 'darwin':
+        subprocess.run(['afplay', path])
+    else:
+        subprocess.run(['aplay', '-q', path])
+
+class AudioCache():
+    # Rendered speech on disk keyed by (voice, text), evicting the least
+    # recently used clips once the folder grows past max_bytes
+    def __init__(self, cache_dir, max_bytes):
+        self.__cache_dir = cache_dir
+        self.__max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        
+        # key -> size in bytes, least recently used first
+        self.__entries = collections.OrderedDict()
+        clips = [e for e in os.scandir(cache_dir) if e.is_file() and e.name.endswith('.wav')]
+        for entry in sorted(clips, key=lambda e: e.stat().st_mtime):
+            self.__entries[entry.name[:-len('.wav')]] = entry.stat().st_size
+        self.__total_bytes = sum(self.__entries.values())
+        
+    def key(self, voice_name, text):
+        return hashlib.sha1(f'{voice_name}\0{text}'.encode('utf-8')).hexdigest()
+        
+    def path(self, key):
+        return os.path.join(self.__cache_dir, f'{key}.wav')
+        
+    def get(self, key):
+        if key not in self.__entries:
+            return None
+        self.__entries.move_to_end(key)
+        path = self.path(key)
+        try:
+            # mtime keeps the LRU order across restarts
+            os.utime(path)
+        except OSError:
+            self.__total_bytes -= self.__entries.pop(key)
+            return None
+        return path
+        
+    def add(self, key):
+        size = os.path.getsize(self.path(key))
+        self.__total_bytes += size - self.__entries.get(key, 0)
+        self.__entries[key] = size
+        self.__entries.move_to_end(key)
+        
+        # never evict the clip we just added
+        while self.__total_bytes > self.__max_bytes and len(self.__entries) > 1:
+            old_key, old_size = self.__entries.popitem(last=False)
+            self.__total_bytes -= old_size
+            try:
+                os.remove(self.path(old_key))
+            except OSError:
+                pass
 
 class TTS():
-    def __init__(self, volume=0.4):
-        self.__tts_engine = pyttsx3.init()
+    VoiceNames = [
+        'Microsoft David Desktop - English (United States)',
+        'Microsoft Hazel Desktop - English (Great Britain)',
+        'Microsoft Hedda Desktop - German',
+        'Microsoft Zira Desktop - English (United States)',
+        'Microsoft Helena Desktop - Spanish (Spain)',
+        'Microsoft Sabina Desktop - Spanish (Mexico)',
+        'Microsoft Hortense Desktop - French',
+        'Microsoft Haruka Desktop - Japanese',
+        'Microsoft Heami Desktop - Korean',
+        'Microsoft Irina Desktop - Russian'
+    ]
+    
+    def __init__(self, volume=0.4, backend='pyttsx3', cache=None):
+        self.__backend = backend
+        self.__tts_engine = FakeTTSEngine() if backend == 'fake' else pyttsx3.init()
         self.__tts_voices = self.__tts_engine.getProperty('voices')
+        # name -> id, looked up on every message
+        self.__tts_voice_ids = { voice.name: voice.id for voice in self.__tts_voices }
+        self.__cache = cache
         
         self.__tts_engine.setProperty('volume', volume)
         
-        self.tts_voice_names = [
-            'Microsoft David Desktop - English (United States)',
-            'Microsoft Hazel Desktop - English (Great Britain)',
-            'Microsoft Hedda Desktop - German',
-            'Microsoft Zira Desktop - English (United States)',
-            'Microsoft Helena Desktop - Spanish (Spain)',
-            'Microsoft Sabina Desktop - Spanish (Mexico)',
-            'Microsoft Hortense Desktop - French',
-            'Microsoft Haruka Desktop - Japanese',
-            'Microsoft Heami Desktop - Korean',
-            'Microsoft Irina Desktop - Russian'
-        ]
+        self.tts_voice_names = TTS.VoiceNames
         
     ###########################################################################
     # Public facing methods
     ###########################################################################
     def find_voice(self, name_to_find):
-        for i in range(len(self.__tts_voices)):
-            if self.__tts_voices[i].name == name_to_find:
-                return self.__tts_voices[i].id
+        if name_to_find in self.__tts_voice_ids:
+            return self.__tts_voice_ids[name_to_find]
         return self.__tts_voices[random.randrange(0, len(self.__tts_voices))].id
         
     def speak_tts_blocking(self, voice_id, msg):
+        if self.__cache:
+            self.play_blocking(self.render(voice_id, msg))
+            return
+            
+        self.__tts_engine.setProperty('voice', self.find_voice(self.__get_voice_name(voice_id)))
+        self.__tts_engine.say(msg)
+        self.__tts_engine.runAndWait()
+        
+    def render(self, voice_id, msg):
+        # synthesize to a wav in the cache (or reuse it) and return its path
+        voice_name = self.__get_voice_name(voice_id)
+        key = self.__cache.key(voice_name, msg)
+        path = self.__cache.get(key)
+        if path:
+            return path
+            
+        path = self.__cache.path(key)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        self.__tts_engine.setProperty('voice', self.find_voice(voice_name))
+        self.__tts_engine.save_to_file(msg, temp_path)
+        self.__tts_engine.runAndWait()
+        os.replace(temp_path, path)
+        self.__cache.add(key)
+        return path
+        
+    def play_blocking(self, path):
+        if self.__backend == 'fake':
+            time.sleep(wav_seconds(path))
+        else:
+            play_wav_blocking(path)
+            
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __get_voice_name(self, voice_id):
         if 0 > voice_id or voice_id >= len(self.tts_voice_names):
-            voice_id = random.randrange(0, len(self.__tts_voices))
+            voice_id = random.randrange(0, len(self.tts_voice_names))
+        return self.tts_voice_names[voice_id]
+
+def tts_worker_main(requests, done, volume, backend, cache_dir, cache_max_bytes):
+    # Runs in its own process. The main thread renders the next message while
+    # the player thread is still playing the previous one.
+    tts = TTS(volume, backend, AudioCache(cache_dir, cache_max_bytes))
+    rendered = queue.Queue(maxsize=1)
+    
+    def play():
+        while True:
+            item = rendered.get()
+            if item is None:
+                break
+            job_id, path = item
+            try:
+                tts.play_blocking(path)
+            except Exception as e:
+                print(f'TTS playback failed: {e}')
+            done.put(job_id)
             
-        voice_id = self.find_voice(self.tts_voice_names[voice_id])
+    player = threading.Thread(target=play, daemon=True)
+    player.start()
+    
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+            
+        job_id, voice_id, msg = request
+        try:
+            rendered.put((job_id, tts.render(voice_id, msg)))
+        except Exception as e:
+            print(f'TTS failed: {e}')
+            done.put(job_id)
+            
+    rendered.put(None)
+    player.join()
+    done.put(None)
+
+class TTSJob():
+    def __init__(self, job_id, voice_id, msg, priority, on_drop):
+        self.job_id = job_id
+        self.voice_id = voice_id
+        self.msg = msg
+        self.priority = priority
+        self.on_drop = on_drop
+        self.estimated_seconds = estimate_speech_seconds(msg)
+        self.queued_at = time.monotonic()
+        self.started_at = None
         
-        self.__tts_engine.setProperty('voice', voice_id)
-        self.__tts_engine.say(msg)
-        self.__tts_engine.runAndWait()
\ No newline at end of file
+    def __lt__(self, other):
+        # higher priority first, then first come first served
+        return (-self.priority, self.job_id) < (-other.priority, other.job_id)
+
+class TTSQueue():
+    # Feeds a dedicated TTS worker process from a bounded priority queue so
+    # speaking never blocks the event loop. When the queue is full (by count
+    # or by total queued speech time) the lowest priority message is dropped
+    # and its on_drop callback is called, e.g. to refund the redemption.
+    # The next message is handed to the worker while the current one is still
+    # playing so it can be rendered (or pulled from the audio cache) ahead.
+    MaxInFlight = 2
+    
+    def __init__(self, volume=0.4, backend='pyttsx3', max_length=20, max_queued_seconds=300.0, max_message_seconds=30.0, cache_dir='tts_cache', cache_max_bytes=64 * 1024 * 1024):
+        self.__volume = volume
+        self.__backend = backend
+        self.__cache_dir = cache_dir
+        self.__cache_max_bytes = cache_max_bytes
+        self.__max_length = max_length
+        self.__max_queued_seconds = max_queued_seconds
+        self.__max_message_seconds = max_message_seconds
+        
+        self.__heap = []
+        self.__job_ids = itertools.count()
+        # jobs sent to the worker, the first one is the one playing
+        self.__in_flight = collections.deque()
+        self.__wakeup = None
+        self.__dispatcher = None
+        self.__process = None
+        self.__requests = None
+        self.__done = None
+        
+        self.num_spoken = 0
+        self.num_dropped = 0
+        
+    ###########################################################################
+    # Public facing methods
+    ###########################################################################
+    def enqueue(self, voice_id, msg, priority=0, on_drop=None):
+        self.__ensure_dispatcher()
+        
+        job = TTSJob(next(self.__job_ids), voice_id, self.__truncate(msg), priority, on_drop)
+        heapq.heappush(self.__heap, job)
+        
+        # make room by dropping the lowest priority (newest on ties) messages
+        while len(self.__heap) > self.__max_length or (len(self.__heap) > 1 and self.__queued_seconds() > self.__max_queued_seconds):
+            self.__drop(max(self.__heap))
+            
+        self.__wakeup.set()
+        return job if job in self.__heap else None
+        
+    def status(self):
+        return {
+            'depth': len(self.__heap),
+            'speaking': self.__in_flight[0].msg if self.__in_flight else None,
+            'rendering': len(self.__in_flight) - 1 if self.__in_flight else 0,
+            'queued_seconds': self.__queued_seconds(),
+            'estimated_wait_seconds': self.__in_flight_remaining() + self.__queued_seconds(),
+            'oldest_wait_seconds': max((time.monotonic() - job.queued_at for job in self.__heap), default=0.0),
+            'spoken': self.num_spoken,
+            'dropped': self.num_dropped,
+        }
+        
+    async def close(self):
+        if self.__dispatcher:
+            self.__dispatcher.cancel()
+            self.__dispatcher = None
+        if self.__process:
+            self.__requests.put(None)
+            await asyncio.get_running_loop().run_in_executor(None, self.__process.join, 5)
+            self.__stop_process()
+            
+    ###########################################################################
+    # Private helper methods
+    ###########################################################################
+    def __ensure_dispatcher(self):
+        if not self.__dispatcher or self.__dispatcher.done():
+            self.__wakeup = asyncio.Event()
+            self.__dispatcher = asyncio.get_running_loop().create_task(self.__run())
+            
+    def __start_process(self):
+        # spawn so the engine (COM on Windows) is set up fresh in the child
+        context = multiprocessing.get_context('spawn')
+        self.__requests = context.Queue()
+        self.__done = context.Queue()
+        self.__process = context.Process(target=tts_worker_main, args=(self.__requests, self.__done, self.__volume, self.__backend, self.__cache_dir, self.__cache_max_bytes), daemon=True)
+        self.__process.start()
+        
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=self.__read_done, args=(loop, self.__done), daemon=True).start()
+        
+    def __stop_process(self):
+        if self.__process.is_alive():
+            self.__process.terminate()
+        # unblocks this process's done reader
+        self.__done.put(None)
+        self.__process = None
+        
+    def __read_done(self, loop, done):
+        while True:
+            job_id = done.get()
+            if job_id is None:
+                break
+            loop.call_soon_threadsafe(self.__on_done, job_id)
+            
+    def __on_done(self, job_id):
+        for job in self.__in_flight:
+            if job.job_id == job_id:
+                self.__in_flight.remove(job)
+                self.num_spoken += 1
+                break
+        if self.__in_flight and self.__in_flight[0].started_at is None:
+            self.__in_flight[0].started_at = time.monotonic()
+        if self.__wakeup:
+            self.__wakeup.set()
+            
+    async def __run(self):
+        while True:
+            while self.__heap and len(self.__in_flight) < TTSQueue.MaxInFlight:
+                if not self.__process or not self.__process.is_alive():
+                    self.__start_process()
+                    
+                job = heapq.heappop(self.__heap)
+                if not self.__in_flight:
+                    job.started_at = time.monotonic()
+                self.__in_flight.append(job)
+                self.__requests.put((job.job_id, job.voice_id, job.msg))
+                
+            # the worker reports each message once it's done playing, restart it if it hung or died
+            timeout = None
+            if self.__in_flight:
+                playing = self.__in_flight[0]
+                timeout = playing.started_at + playing.estimated_seconds * 3 + 10 - time.monotonic()
+                
+            self.__wakeup.clear()
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                print('TTS worker stopped responding, restarting it')
+                self.__stop_process()
+                while self.__in_flight:
+                    job = self.__in_flight.popleft()
+                    self.num_dropped += 1
+                    if job.on_drop:
+                        job.on_drop(job)
+                        
+    def __drop(self, job):
+        self.__heap.remove(job)
+        heapq.heapify(self.__heap)
+        self.num_dropped += 1
+        if job.on_drop:
+            job.on_drop(job)
+            
+    def __truncate(self, msg):
+        max_words = max(1, int((self.__max_message_seconds - 0.5) * WORDS_PER_MINUTE / 60.0))
+        return ' '.join(msg.split()[:max_words])
+        
+    def __queued_seconds(self):
+        return sum(job.estimated_seconds for job in self.__heap)
+        
+    def __in_flight_remaining(self):
+        remaining = 0.0
+        for job in self.__in_flight:
+            if job.started_at is None:
+                remaining += job.estimated_seconds
+            else:
+                remaining += max(0.0, job.estimated_seconds - (time.monotonic() - job.started_at))
+        return remaining